@@ -1,8 +1,8 @@
-from fastapi import FastAPI
-import uvicorn, pickle, os, logfire
-from openai import AsyncOpenAI, RateLimitError
-from utils import convert_from_b64_and_transcribe, convert_opus_base64_to_mp3, clone_voice_from_samples, get_voices
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from fastapi import FastAPI, Response
+import uvicorn, os, logfire, asyncio, bisect, time, scheduler, notifier, search, retrieval, style, storage, conversation_format
+from conversation_format import Message
+from contextlib import asynccontextmanager
+from utils import decode_audio, transcribe_audio, save_audio, clone_voice_from_samples, get_voices, MIN_SAMPLE_DURATION
 from dotenv import load_dotenv
 
 
@@ -16,13 +16,67 @@ logfire.configure(
 )
 
 
-bot = Bot(os.getenv('TELEGRAM_BOT_TOKEN'))
+# The SDK clients are heavy to import, they are built on first use so the API starts listening right away
+bot = None
+openai = None
 
-openai = AsyncOpenAI(
-    api_key=os.getenv('OPENAI_API_KEY')
-)
+def get_bot():
+    global bot
+    if bot is None:
+        from telegram import Bot
+        bot = Bot(os.getenv('TELEGRAM_BOT_TOKEN'))
+    return bot
+
+def get_openai():
+    global openai
+    if openai is None:
+        from openai import AsyncOpenAI
+        # Retries are handled by the scheduler, shared with the rest of the providers
+        openai = AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            max_retries=0
+        )
+    return openai
+
+started_at = time.monotonic()
+# Set once the startup is over, requests that need the stored data wait for it instead of failing
+ready = asyncio.Event()
+# Set if the startup failed, requests are answered with the error instead of waiting forever
+startup_error = None
+background_tasks = []
+
+async def wait_ready():
+    await ready.wait()
+    if startup_error is not None:
+        raise RuntimeError(f'The API failed to start: {startup_error}')
+
+async def warmup():
+    global conversation_files, samples, startup_error
+    with logfire.span('warmup'):
+        try:
+            conversation_files, samples = await asyncio.to_thread(lambda: (list_conversations(), load_samples()))
+            background_tasks.append(notifier.start(get_bot(), os.getenv('TELEGRAM_CHAT_ID')))
+            logfire.info("API ready", startup_ms=(time.monotonic() - started_at) * 1000)
+        except Exception as e:
+            startup_error = e
+            logfire.error("Error during warmup, requests will fail until the API is restarted", error=e)
+            return
+        finally:
+            ready.set()
+        try:
+            # Index whatever history isn't indexed yet
+            await asyncio.to_thread(search.index_conversations, read_stored_conversations())
+        except Exception as e:
+            logfire.error("Error indexing conversations", error=e)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    background_tasks.append(asyncio.create_task(warmup()))
+    yield
+    for task in background_tasks + list(embedding_tasks.values()):
+        task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 
 if not os.path.exists('conversations'):
     os.makedirs('conversations')
@@ -33,72 +87,150 @@ if not os.path.exists('samples'):
 if not os.path.exists('audios'):
     os.makedirs('audios')
 
-async def send_to_telegram(chat_id, message):
-    with logfire.span('send_to_telegram', chat_id=chat_id, message=message):
+def load_directory(directory):
+    # Every file is loaded on its own, a corrupted file doesn't prevent loading the rest
+    data = {}
+    for filename in storage.list_files(directory):
         try:
-            keyboard = InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("Complete", callback_data=f'complete_{chat_id}_{message["id"].split("_")[2]}')]
-                ]
-            )
-            result = await bot.send_message(os.getenv('TELEGRAM_CHAT_ID'), f'<b>{message["sender"]["shortName"]}</b>: <i>{message["content"]}</i>', parse_mode='HTML', reply_markup=keyboard)
-            logfire.info("Message sent to telegram")
+            data[filename.replace('.pkl', '')] = storage.load_pickle(f'{directory}/{filename}')
         except Exception as e:
-            logfire.error("Error sending message to telegram", error=e)
-            return
-        return result
+            logfire.error(f"Error loading {directory}/{filename}", error=e)
+    return data
 
 def load_samples():
     with logfire.span('load_samples'):
         try:
-            samples = {}
-            for telephone in [telephone.replace('.pkl', '') for telephone in os.listdir('samples')]:
-                samples[telephone] = pickle.load(open(f'samples/{telephone}.pkl', 'rb'))
-            logfire.info("Samples loaded successfully")
+            samples = load_directory('samples')
+            logfire.info("Samples loaded successfully", count=len(samples))
             return samples
         except Exception as e:
             logfire.error("Error loading samples", error=e)
             return {}
 
-def load_conversations():
-    with logfire.span('load_conversations'):
+def list_conversations():
+    # Conversations are only read when their chat is used, the startup just lists their files
+    with logfire.span('list_conversations'):
         try:
-            conversations = {}
-            for telephone in [telephone.replace('.pkl', '') for telephone in os.listdir('conversations')]:
-                conversations[telephone] = pickle.load(open(f'conversations/{telephone}.pkl', 'rb'))
-            logfire.info("Conversations loaded successfully")
-            return conversations
+            files = {}
+            # Pickled conversations from previous versions are still loaded, they are converted on their next save
+            for filename in storage.list_files('conversations', conversation_format.EXTENSION) + storage.list_files('conversations'):
+                files.setdefault(os.path.splitext(filename)[0], f'conversations/{filename}')
+            logfire.info("Conversations listed successfully", count=len(files))
+            return files
         except Exception as e:
-            logfire.error("Error loading conversations", error=e)
+            logfire.error("Error listing conversations", error=e)
             return {}
 
-def save_conversation(telephone, conversation):
+def read_stored_conversations():
+    # One chat at a time, so the chats that aren't used don't stay in memory
+    for chat_id, path in list(conversation_files.items()):
+        conversation = conversations.get(chat_id)
+        if conversation is None:
+            try:
+                conversation = conversation_format.load_conversation(path)
+            except Exception as e:
+                logfire.error(f"Error loading {path}", error=e)
+                continue
+        yield chat_id, list(conversation)
+
+async def get_conversation(chat_id):
+    """Returns the conversation of the chat, read from disk the first time it is used, or None for a new chat."""
+    if chat_id not in conversations and chat_id in conversation_files:
+        path = conversation_files[chat_id]
+        with logfire.span('load_conversation', chat_id=chat_id):
+            try:
+                conversation = await asyncio.to_thread(conversation_format.load_conversation, path)
+            except Exception as e:
+                # The chat starts again as a new one, as when every conversation was loaded at startup
+                logfire.error(f"Error loading {path}", error=e)
+                return None
+        # Another request may have read it meanwhile, and already added messages to it
+        conversations.setdefault(chat_id, conversation)
+    return conversations.get(chat_id)
+
+async def save_conversation(telephone, conversation):
     with logfire.span('save_conversation', telephone=telephone):
         try:
-            pickle.dump(conversation, open(f'conversations/{telephone}.pkl', 'wb'))
+            data = await asyncio.to_thread(conversation_format.encode, conversation)
+            await storage.save(f'conversations/{telephone}{conversation_format.EXTENSION}', data)
             logfire.info("Conversation saved successfully", telephone=telephone)
         except Exception as e:
             logfire.error("Error saving conversation", telephone=telephone, error=e)
 
-conversations = load_conversations()
-samples = load_samples()
+conversation_files = {}
+conversations = {}
+samples = {}
+
+# Approximate amount of tokens of conversation sent to the model on each completion
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET') or 12000)
+# When the style of User 1 is described by a profile, less history is needed
+STYLE_CONTEXT_TOKEN_BUDGET = int(os.getenv('STYLE_CONTEXT_TOKEN_BUDGET') or 3000)
+
+# One lock per chat so that messages of the same chat are stored in order
+# while different chats are processed concurrently
+chat_locks = {}
+
+def get_chat_lock(chat_id):
+    if chat_id not in chat_locks:
+        chat_locks[chat_id] = asyncio.Lock()
+    return chat_locks[chat_id]
 
-def save_sample(telephone, sample):
+# Ids of the messages received in each chat, so redelivered messages (e.g. a resync after
+# a restart) are detected before any work is done on them
+message_ids = {}
+
+async def get_message_ids(chat_id):
+    if chat_id not in message_ids:
+        ids = {m.message_id for m in await get_conversation(chat_id) or []}
+        message_ids.setdefault(chat_id, ids)
+    return message_ids[chat_id]
+
+def insert_message(conversation, entry):
+    # Messages may arrive late (e.g. after a long transcription), so insert by WhatsApp timestamp
+    # instead of appending. Messages with the same timestamp keep their arrival order.
+    index = bisect.bisect_right(conversation, entry.timestamp, key=lambda m: m.timestamp)
+    conversation.insert(index, entry)
+
+# Embeddings are computed ahead of the completions, off the ingest path. Each chat has at most
+# one task, which waits for bursts of messages to end and embeds them all in one batch.
+EMBEDDINGS_DELAY = 2
+embedding_tasks = {}
+embeddings_outdated = set()
+
+def schedule_embeddings(chat_id):
+    embeddings_outdated.add(chat_id)
+    if chat_id not in embedding_tasks:
+        embedding_tasks[chat_id] = asyncio.create_task(update_embeddings(chat_id))
+
+async def update_embeddings(chat_id):
+    try:
+        while chat_id in embeddings_outdated:
+            await asyncio.sleep(EMBEDDINGS_DELAY)
+            embeddings_outdated.discard(chat_id)
+            snapshot = list(conversations[chat_id])
+            await asyncio.get_running_loop().run_in_executor(retrieval.executor, retrieval.index_conversation, chat_id, snapshot)
+    finally:
+        del embedding_tasks[chat_id]
+
+async def save_sample(telephone, sample):
     with logfire.span('save_sample', telephone=telephone):
         try:
-            pickle.dump(sample, open(f'samples/{telephone}.pkl', 'wb'))
+            await storage.save_pickle(f'samples/{telephone}.pkl', sample)
             logfire.info("Sample saved successfully", telephone=telephone)
         except Exception as e:
             logfire.error("Error saving sample", telephone=telephone, error=e)
 
-def format_conversation(conversation, from_message):
+def format_conversation(conversation, from_message, style_prompt=None):
     with logfire.span('format_conversation', from_message=from_message):
         try:
             formatted_conversation = []
-            formatted_conversation.append({"role": "user" if os.getenv('OPENAI_MODEL').startswith('o') else "system", "content": "You are a personal assistant that can complete conversations on behalf of User 1. Read the conversation and respond as if you were User 1, respecting the tone of voice and writing style of User 1."})
+            instructions = "You are a personal assistant that can complete conversations on behalf of User 1. Read the conversation and respond as if you were User 1, respecting the tone of voice and writing style of User 1."
+            if style_prompt:
+                instructions += f"\n\n{style_prompt}"
+            formatted_conversation.append({"role": "user" if os.getenv('OPENAI_MODEL').startswith('o') else "system", "content": instructions})
             for message in conversation:
-                formatted_conversation.append({"role": "assistant" if message["fromMe"] else "user", "content": f'User 1: {message["content"]}' if message["fromMe"] else f'User 2: {message["content"]}'})
-                if message["messageId"] == from_message:
+                formatted_conversation.append({"role": "assistant" if message.from_me else "user", "content": f'User 1: {message.content}' if message.from_me else f'User 2: {message.content}'})
+                if message.message_id == from_message:
                     break
             logfire.info("Conversation formatted successfully")
             return formatted_conversation
@@ -107,27 +239,34 @@ def format_conversation(conversation, from_message):
             return []
 
 
+async def create_completion(messages):
+    # The raw response exposes the rate limit headers to the scheduler. Rate limit errors aren't
+    # retried, complete_conversation answers them with a smaller context right away.
+    raw_response = await scheduler.run('openai', lambda: get_openai().chat.completions.with_raw_response.create(
+        model=os.getenv('OPENAI_MODEL'),
+        messages=messages
+    ), priority=scheduler.INTERACTIVE, retry_rate_limits=False)
+    return raw_response.parse()
+
 async def complete_conversation(chat_id, from_message):
+    from openai import RateLimitError
     with logfire.span('complete_conversation', chat_id=chat_id, from_message=from_message):
         try:
-            conversation = conversations[chat_id]
-            formatted_conversation = format_conversation(conversation, from_message)
+            conversation = list(conversations[chat_id])
+            style_prompt = await asyncio.to_thread(style.get_style_prompt, chat_id, conversation)
+            budget = STYLE_CONTEXT_TOKEN_BUDGET if style_prompt else CONTEXT_TOKEN_BUDGET
+            context = await asyncio.to_thread(retrieval.select_context, chat_id, conversation, from_message, budget)
+            formatted_conversation = format_conversation(context, from_message, style_prompt)
             try:
-                response = await openai.chat.completions.create(
-                    model=os.getenv('OPENAI_MODEL'),
-                    messages=formatted_conversation
-                )
+                response = await create_completion(formatted_conversation)
             except RateLimitError as e:
-                logfire.warning("Rate limit error, trying with truncated conversation", error=e)
-                # Try again with only last 50 messages
-                truncated_conversation = formatted_conversation[:1] + formatted_conversation[-min(50, len(formatted_conversation)-1):]
+                logfire.warning("Rate limit error, trying with a smaller context", error=e)
+                # Try again with a quarter of the budget, still keeping the most relevant messages
+                context = await asyncio.to_thread(retrieval.select_context, chat_id, conversation, from_message, budget // 4)
                 try:
-                    response = await openai.chat.completions.create(
-                        model=os.getenv('OPENAI_MODEL'),
-                        messages=truncated_conversation
-                    )
+                    response = await create_completion(format_conversation(context, from_message, style_prompt))
                 except Exception as e2:
-                    logfire.error("Error completing conversation with truncated messages", error=e2)
+                    logfire.error("Error completing conversation with a smaller context", error=e2)
                     return {"message": str(e2), "error": True}
             logfire.info("Conversation completed successfully")
             return response.choices[0].message.content
@@ -140,11 +279,17 @@ async def delete_sample(data: dict):
     with logfire.span('delete_sample', telephone=data.get('telephone'), sample=data.get('sample')):
         try:
             global samples
+            await wait_ready()
             telephone = data['telephone']
             sample = data['sample']
-            samples[telephone] = [s for s in samples.get(telephone, []) if s != f'audios/{sample}']
-            save_sample(telephone, samples[telephone])
-            os.remove(f'audios/{sample}')
+            # Samples are matched by message id, they may be stored in any format
+            sample_id = os.path.splitext(sample)[0]
+            removed = [s for s in samples.get(telephone, []) if os.path.splitext(os.path.basename(s))[0] == sample_id]
+            samples[telephone] = [s for s in samples.get(telephone, []) if s not in removed]
+            await save_sample(telephone, samples[telephone])
+            for path in removed + [f'audios/{sample_id}.mp3']:
+                if os.path.exists(path):
+                    os.remove(path)
             logfire.info("Sample deleted successfully", telephone=telephone, sample=sample)
             return {"message": "Sample deleted", "error": False}
         except Exception as e:
@@ -156,9 +301,10 @@ async def complete(data: dict):
     with logfire.span('complete', chat_id=data.get('chatId'), message_id=data.get('messageId')):
         try:
             global conversations
+            await wait_ready()
             chat_id = data['chatId']
             message_id = data['messageId']
-            if chat_id not in conversations.keys():
+            if await get_conversation(chat_id) is None:
                 logfire.warning("Chat not found", chat_id=chat_id)
                 return {"message": "Chat not found", "error": True}
             else:
@@ -174,14 +320,15 @@ async def clone(data: dict):
     with logfire.span('clone', telephone=data.get('telephone'), name=data.get('name')):
         try:
             global samples
+            await wait_ready()
             telephone = data['telephone']
             if telephone not in samples.keys():
                 logfire.warning("Telephone not found", telephone=telephone)
                 return {"message": "Telephone not found", "error": True}
             else:
                 try:
-                    voice = clone_voice_from_samples(samples[telephone], data['prompt'], data['name'])
-                    voices = get_voices()
+                    voice = await clone_voice_from_samples(samples[telephone], data['prompt'], data['name'])
+                    voices = await get_voices()
                     logfire.info("Voice cloned successfully", telephone=telephone, voice=voice)
                     return {"message": voice, "error": False, "voices": voices, "voice": voice}
                 except Exception as e:
@@ -195,25 +342,46 @@ async def clone(data: dict):
 async def voices():
     with logfire.span('voices'):
         try:
-            voices_data = get_voices().model_dump()['voices']
+            voices_data = (await get_voices()).model_dump()['voices']
             logfire.info("Voices retrieved successfully", count=len(voices_data))
             return {"voices": voices_data, "error": False}
         except Exception as e:
             logfire.error("Error getting voices", error=e)
             return {"message": str(e), "error": True}
 
+@app.get('/health')
+async def health(response: Response):
+    if startup_error is not None:
+        response.status_code = 503
+        return {"status": "error", "ready": False, "error": str(startup_error), "uptime": time.monotonic() - started_at}
+    if not ready.is_set():
+        response.status_code = 503
+    return {"status": "ok", "ready": ready.is_set(), "uptime": time.monotonic() - started_at}
+
+@app.get('/search')
+async def search_messages(q: str, limit: int = 10):
+    with logfire.span('search', query=q, limit=limit):
+        try:
+            start = time.perf_counter()
+            results = await asyncio.to_thread(search.search, q, limit)
+            took_ms = (time.perf_counter() - start) * 1000
+            logfire.info("Search completed successfully", count=len(results), took_ms=took_ms)
+            return {"results": results, "took_ms": took_ms, "error": False}
+        except Exception as e:
+            logfire.error("Error searching messages", error=e)
+            return {"message": str(e), "error": True}
+
 @app.post('/new_message')
 async def new_message(message: dict):
     with logfire.span('new_message', chat_id=message.get("chatId", {}).get("user")):
         try:
             global conversations
             global samples
+            await wait_ready()
             chat_id = message["chatId"]["user"]
             if len(chat_id) > 14:
                 logfire.warning("Invalid chat_id length", chat_id=chat_id)
                 return
-            if chat_id not in conversations.keys():
-                conversations[chat_id] = []
             try:
                 int(message["from"].split("@")[0])
             except:
@@ -222,49 +390,64 @@ async def new_message(message: dict):
             if message["sender"]["shortName"] in ["None", "none", "NONE", None]:
                 logfire.warning("Invalid sender name", sender=message.get("sender"))
                 return
-            if message.get("base_64_audio") != None:
-                from_telephone = message["from"].split("@")[0]
-                if from_telephone not in samples.keys():
-                    samples[from_telephone] = []
-                output_file = convert_opus_base64_to_mp3(message["base_64_audio"], f"audios/{message['id'].split('_')[2]}.mp3")
-                samples[from_telephone].append(output_file)
-                save_sample(from_telephone, samples[from_telephone])
-                retries = 3
-                while retries > 0:
+            message_id = message["id"].split("_")[2]
+            received = await get_message_ids(chat_id)
+            if message_id in received:
+                logfire.warning("Duplicated message", chat_id=chat_id, message_id=message_id)
+                return {"message": "Message already received"}
+            # Claimed before transcribing so a redelivery arriving meanwhile is skipped too,
+            # and released if the message isn't stored so it can be received again
+            received.add(message_id)
+            stored = False
+            try:
+                if message.get("base_64_audio") != None:
+                    audio = decode_audio(message["base_64_audio"])
+                    logfire.info("Audio decoded", codec=audio["codec"], duration=audio["duration"], size=len(audio["data"]))
+                    from_telephone = message["from"].split("@")[0]
+                    if audio["duration"] is None or audio["duration"] >= MIN_SAMPLE_DURATION:
+                        if from_telephone not in samples.keys():
+                            samples[from_telephone] = []
+                        output_file = save_audio(audio, f"audios/{message_id}")
+                        samples[from_telephone].append(output_file)
+                        await save_sample(from_telephone, samples[from_telephone])
+                    else:
+                        logfire.info("Audio too short to be used as a sample", duration=audio["duration"])
                     try:
-                        transcription = await convert_from_b64_and_transcribe(message["base_64_audio"])
-                        break
+                        transcription = await transcribe_audio(audio)
                     except Exception as e:
-                        logfire.warning(f"Transcription retry {3-retries+1}/3 failed", error=e)
-                        retries -= 1
-                else:
-                    logfire.error("All transcription retries failed")
-                    return {"message": "Error transcribing audio", "error": True}
-                message["content"] = transcription
-                logfire.info("Audio transcribed successfully")
-
-            if message['fromMe']:
-                conversations[chat_id].append({
-                    "from": message["from"].split("@")[0],
-                    "fromMe": True,
-                    "name": message["sender"]["shortName"],
-                    "content": message["content"],
-                    "messageId": message["id"].split("_")[2],
-                    "timestamp": message["t"]
-                    }
+                        logfire.error("Error transcribing audio", error=e)
+                        return {"message": "Error transcribing audio", "error": True}
+                    message["content"] = transcription
+                    logfire.info("Audio transcribed successfully")
+
+                entry = Message(
+                    sender=message["from"].split("@")[0],
+                    from_me=bool(message['fromMe']),
+                    name=message["sender"]["shortName"],
+                    content=message["content"],
+                    message_id=message_id,
+                    timestamp=message["t"]
                 )
-            else:
-                conversations[chat_id].append({
-                    "from": message["from"].split("@")[0],
-                    "fromMe": False,
-                    "name": message["sender"]["shortName"],
-                    "content": message["content"],
-                    "messageId": message["id"].split("_")[2],
-                    "timestamp": message["t"]
-                })
-                await send_to_telegram(chat_id, message)
-
-            save_conversation(chat_id, conversations[chat_id])
+                async with get_chat_lock(chat_id):
+                    conversation = await get_conversation(chat_id)
+                    if conversation is None:
+                        conversation = conversations[chat_id] = []
+                    insert_message(conversation, entry)
+                    stored = True
+                    await asyncio.to_thread(search.index_message, chat_id, entry)
+                    # Saved while holding the lock so the writes of a chat keep their order
+                    snapshot = list(conversation)
+                    await save_conversation(chat_id, snapshot)
+                    if entry.from_me:
+                        await asyncio.to_thread(style.update, chat_id, snapshot, entry)
+            finally:
+                if not stored:
+                    received.discard(message_id)
+            schedule_embeddings(chat_id)
+
+            if not message['fromMe']:
+                notifier.notify(chat_id, message)
+
             logfire.info("New message processed successfully", chat_id=chat_id)
             return {"message": "Message received"}
         except Exception as e:
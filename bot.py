@@ -1,11 +1,11 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, ConversationHandler, MessageHandler, filters
 from httpx import AsyncClient
-from elevenlabs.types import VoiceSettings
 from dotenv import load_dotenv
-import random, os, pickle, logfire
+import random, os, html, logfire, datetime, storage
 
 from utils import text_to_speech, edit_voice_settings, delete_voice
+from health import start_health_server
 
 logfire.configure(
     send_to_logfire='if-token-present',
@@ -25,7 +25,7 @@ def load_thought_messages():
     with logfire.span('load_thought_messages'):
         try:
             if os.path.exists('thought_messages.pkl'):
-                messages = pickle.load(open('thought_messages.pkl', 'rb'))
+                messages = storage.load_pickle('thought_messages.pkl')
                 logfire.info("Thought messages loaded successfully", count=sum(len(msgs) for msgs in messages.values()))
                 return messages
             else:
@@ -37,10 +37,10 @@ def load_thought_messages():
 
 thought_messages = load_thought_messages()
 
-def save_thought_messages():
+async def save_thought_messages():
     with logfire.span('save_thought_messages'):
         try:
-            pickle.dump(thought_messages, open('thought_messages.pkl', 'wb'))
+            await storage.save_pickle('thought_messages.pkl', thought_messages)
             logfire.info("Thought messages saved successfully", count=sum(len(msgs) for msgs in thought_messages.values()))
         except Exception as e:
             logfire.error("Error saving thought messages", error=e)
@@ -174,13 +174,14 @@ async def edit_voice_settings_command(update: Update, context: ContextTypes.DEFA
                 await update.effective_chat.send_message(f'Usage: /editvoicesettings <voice_id> <stability> <similarity_boost> <style> <use_speaker_boost (True/False)>')
                 logfire.warning("Invalid arguments for edit voice settings")
                 return
+            from elevenlabs.types import VoiceSettings
             settings = VoiceSettings(
                 stability=float(stability),
                 similarity_boost=float(similarity_boost),
                 style=float(style),
                 use_speaker_boost=use_speaker_boost == 'True'
             )
-            edit_voice_settings(voice_id, settings)
+            await edit_voice_settings(voice_id, settings)
             await update.effective_chat.send_message(f'Voice settings updated successfully!')
             logfire.info("Voice settings updated successfully", voice_id=voice_id, settings=settings)
         except Exception as e:
@@ -192,7 +193,7 @@ async def delete_voice_command(update: Update, context: ContextTypes.DEFAULT_TYP
         try:
             try:
                 voice_id = context.args[0]
-                delete_voice(voice_id)
+                await delete_voice(voice_id)
                 await update.effective_chat.send_message(f'Voice deleted successfully!')
                 logfire.info("Voice deleted successfully", voice_id=voice_id)
             except:
@@ -202,6 +203,34 @@ async def delete_voice_command(update: Update, context: ContextTypes.DEFAULT_TYP
             logfire.error("Error deleting voice", error=e)
             await update.effective_chat.send_message(f'Error deleting voice: {str(e)}')
 
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with logfire.span('search_command', chat_id=update.effective_chat.id):
+        try:
+            query = ' '.join(context.args)
+            if not query:
+                await update.effective_chat.send_message(f'Usage: /search <query>')
+                logfire.warning("Invalid arguments for search")
+                return
+            async with AsyncClient(timeout=120) as client:
+                response = await client.get('http://localhost:47549/search', params={'q': query})
+                response = response.json()
+            if response['error']:
+                await update.effective_chat.send_message(f'Error: {response["message"]}')
+                logfire.error("Error from search API", message=response["message"])
+                return
+            if not response['results']:
+                await update.effective_chat.send_message(f'No results ({response["took_ms"]:.1f} ms)')
+                return
+            msg = f'<i>{len(response["results"])} results in {response["took_ms"]:.1f} ms</i>\n\n'
+            for r in response['results']:
+                date = datetime.datetime.fromtimestamp(r['timestamp']).strftime('%Y-%m-%d %H:%M')
+                msg += f'<code>{r["chatId"]}</code> {date}\n<b>{"Me" if r["fromMe"] else html.escape(r["name"])}</b>: {r["snippet"]}\n\n'
+            await update.effective_chat.send_message(msg, parse_mode='HTML')
+            logfire.info("Search executed successfully", count=len(response['results']))
+        except Exception as e:
+            logfire.error("Error searching messages", error=e)
+            await update.effective_chat.send_message(f'Error searching messages: {str(e)}')
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     with logfire.span('cancel', chat_id=update.effective_chat.id):
         try:
@@ -262,7 +291,7 @@ async def callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             ]
                             ])
                         await message.edit_text(f'<code>{response}</code>', parse_mode='HTML', reply_markup=keyboard)
-                        save_thought_messages()
+                        await save_thought_messages()
                         logfire.info("Message completed successfully", chat_id=chat_id, message_id=message_id)
                     except Exception as e:
                         logfire.error("Error completing message", chat_id=chat_id, message_id=message_id, error=e)
@@ -271,12 +300,12 @@ async def callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
             elif s == 'send':
                 with logfire.span('send_callback', chat_id=chat_id, message_id=message_id):
                     try:
-                        pickle.dump({
+                        await storage.save_pickle(f'sendable_messages/{chat_id}_{message_id}.pkl', {
                             'type': 'text',
                             'telephone': chat_id,
                             'message': thought_messages[chat_id][message_id],
                             'filename': f'{chat_id}_{message_id}.pkl'
-                        }, open(f'sendable_messages/{chat_id}_{message_id}.pkl', 'wb'))
+                        })
                         await query.answer('Queued')
                         logfire.info("Text message queued for sending", chat_id=chat_id, message_id=message_id)
                     except Exception as e:
@@ -289,13 +318,13 @@ async def callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         msg = await update.effective_message.reply_text('Generating audio...')
                         audio, output_file = await text_to_speech(thought_messages[chat_id][message_id], to_ogg=True, to_base64=True, voice_id=voice_id)
                         await msg.delete()
-                        pickle.dump({
+                        await storage.save_pickle(f'sendable_messages/{chat_id}_{message_id}.pkl', {
                             'type': 'audio',
                             'telephone': chat_id,
                             'message': audio,
                             'filename': f'{chat_id}_{message_id}.pkl',
                             'audio_filename': output_file
-                        }, open(f'sendable_messages/{chat_id}_{message_id}.pkl', 'wb'))
+                        })
                         await query.answer('Queued')
                         logfire.info("Audio message queued for sending", chat_id=chat_id, message_id=message_id)
                     except Exception as e:
@@ -304,9 +333,17 @@ async def callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logfire.error("Error processing callback query", error=e)
 
+ready = False
+
+async def post_init(application: Application):
+    global ready
+    ready = True
+    logfire.info("Bot ready")
+
 def main():
     try:
-        application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).build()
+        start_health_server(47550, lambda: ready)
+        application = Application.builder().token(os.getenv('TELEGRAM_BOT_TOKEN')).post_init(post_init).build()
         application.add_handler(convo)
         application.add_handler(CommandHandler('voices', get_voices, block=False))
         application.add_handler(CommandHandler('setvoiceid', set_voice_id, block=False))
@@ -314,6 +351,7 @@ def main():
         application.add_handler(CommandHandler('chatid', chat_id, block=False))
         application.add_handler(CommandHandler('editvoicesettings', edit_voice_settings_command, block=False))
         application.add_handler(CommandHandler('deletevoice', delete_voice_command, block=False))
+        application.add_handler(CommandHandler('search', search_command, block=False))
         application.add_handler(CallbackQueryHandler(callback_query, block=False))
         logfire.info("Application initialized successfully")
         application.run_polling()
@@ -0,0 +1,252 @@
+import os, sys, mmap, pickle, struct, subprocess, time, traceback, tracemalloc
+import logfire, storage
+
+# Conversations are stored column by column:
+#   header | timestamps (int64) | senders, names (uint32 indexes in the string table)
+#   | message id offsets, content offsets (uint32, n+1 each) | string offsets (uint32, s+1)
+#   | fromMe (uint8) | padding | string table | text
+# Sender numbers and names repeat on every message, so they are interned in the string table.
+MAGIC = b'WACF'
+VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+EXTENSION = '.wac'
+
+class Message:
+    __slots__ = ('sender', 'from_me', 'name', 'content', 'message_id', 'timestamp')
+
+    def __init__(self, sender, from_me, name, content, message_id, timestamp):
+        self.sender = sender
+        self.from_me = from_me
+        self.name = name
+        self.content = content
+        self.message_id = message_id
+        self.timestamp = timestamp
+
+    @classmethod
+    def from_dict(cls, message):
+        # Messages stored as dicts by previous versions
+        return cls(message["from"], message["fromMe"], message["name"], message["content"], message["messageId"], message["timestamp"])
+
+    def __repr__(self):
+        return f'Message({self.message_id!r}, {self.name!r}, {self.content!r})'
+
+def section_sizes(count, strings):
+    return [8 * count, 4 * count, 4 * count, 4 * (count + 1), 4 * (count + 1), 4 * (strings + 1), count]
+
+def encode(conversation) -> bytes:
+    strings = {}
+    def intern(value):
+        if value not in strings:
+            strings[value] = len(strings)
+        return strings[value]
+
+    senders = [intern(m.sender or '') for m in conversation]
+    names = [intern(m.name or '') for m in conversation]
+    text = bytearray()
+    id_offsets = [0]
+    for m in conversation:
+        text += (m.message_id or '').encode('utf-8')
+        id_offsets.append(len(text))
+    content_offsets = [len(text)]
+    for m in conversation:
+        text += (m.content or '').encode('utf-8')
+        content_offsets.append(len(text))
+    string_table = bytearray()
+    string_offsets = [0]
+    for value in strings:
+        string_table += value.encode('utf-8')
+        string_offsets.append(len(string_table))
+
+    count = len(conversation)
+    parts = [
+        HEADER.pack(MAGIC, VERSION, 0, count, len(strings)),
+        struct.pack(f'<{count}q', *[int(m.timestamp or 0) for m in conversation]),
+        struct.pack(f'<{count}I', *senders),
+        struct.pack(f'<{count}I', *names),
+        struct.pack(f'<{count + 1}I', *id_offsets),
+        struct.pack(f'<{count + 1}I', *content_offsets),
+        struct.pack(f'<{len(strings) + 1}I', *string_offsets),
+        bytes(bool(m.from_me) for m in conversation)
+    ]
+    data = b''.join(parts)
+    return data + b'\0' * (-len(data) % 8) + bytes(string_table) + bytes(text)
+
+class ConversationView:
+    """Reads a conversation straight from a buffer (e.g. a memory map), decoding only what is accessed."""
+
+    def __init__(self, buffer):
+        buffer = memoryview(buffer)
+        if len(buffer) < HEADER.size:
+            raise storage.CorruptedFile('Truncated conversation header')
+        magic, version, _, self.count, strings = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise storage.CorruptedFile('Not a conversation file')
+        if version != VERSION:
+            raise storage.CorruptedFile(f'Unsupported conversation format version {version}')
+        offset = HEADER.size
+        if len(buffer) < offset + sum(section_sizes(self.count, strings)):
+            raise storage.CorruptedFile('Truncated conversation')
+        columns = []
+        for size, code in zip(section_sizes(self.count, strings), 'qIIIIIB'):
+            columns.append(buffer[offset:offset + size].cast(code))
+            offset += size
+        self.timestamps, self.senders, self.names, self.id_offsets, self.content_offsets, string_offsets, self.from_me = columns
+        offset += -offset % 8
+        table = buffer[offset:offset + string_offsets[-1]]
+        self.strings = [str(table[string_offsets[i]:string_offsets[i + 1]], 'utf-8') for i in range(strings)]
+        self.text = buffer[offset + string_offsets[-1]:]
+
+    def __len__(self):
+        return self.count
+
+    def message_id(self, i):
+        return str(self.text[self.id_offsets[i]:self.id_offsets[i + 1]], 'utf-8')
+
+    def content(self, i):
+        return str(self.text[self.content_offsets[i]:self.content_offsets[i + 1]], 'utf-8')
+
+    def message(self, i):
+        return Message(self.strings[self.senders[i]], bool(self.from_me[i]), self.strings[self.names[i]], self.content(i), self.message_id(i), self.timestamps[i])
+
+    def __iter__(self):
+        return (self.message(i) for i in range(self.count))
+
+    def messages(self):
+        # Decodes every message at once, much faster than going one by one
+        text = bytes(self.text)
+        def strings_between(offsets):
+            offsets = offsets.tolist()
+            return [text[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+        strings = self.strings
+        return [
+            Message(strings[sender], bool(from_me), strings[name], content, message_id, timestamp)
+            for sender, from_me, name, content, message_id, timestamp in zip(
+                self.senders.tolist(), self.from_me.tolist(), self.names.tolist(),
+                strings_between(self.content_offsets), strings_between(self.id_offsets), self.timestamps.tolist()
+            )
+        ]
+
+    def release(self):
+        for view in (self.timestamps, self.senders, self.names, self.id_offsets, self.content_offsets, self.from_me, self.text):
+            view.release()
+
+class ConversationReader:
+    """Memory maps a stored conversation, for scans over the history that don't need it all in memory.
+
+        with ConversationReader('conversations/123.wac') as view:
+            last_week = [view.content(i) for i in range(len(view)) if view.timestamps[i] > since]
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = self.map = self.buffer = self.payload = self.view = None
+
+    def __enter__(self):
+        try:
+            return self.open(self.path)
+        except storage.CorruptedFile as e:
+            backup = storage.backup_path(self.path)
+            if not os.path.exists(backup):
+                raise
+            logfire.warning("Conversation corrupted, reading its backup", path=self.path, error=e)
+            return self.open(backup)
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self, path):
+        self.file = open(path, 'rb')
+        try:
+            if os.fstat(self.file.fileno()).st_size == 0:
+                raise storage.CorruptedFile('Empty file')
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buffer = memoryview(self.map)
+            self.payload = storage.verify_record(self.buffer)
+            self.view = ConversationView(self.payload)
+            return self.view
+        except Exception as e:
+            # The views made before failing are still referenced by the traceback, and the map
+            # can't be closed while any of them exists
+            traceback.clear_frames(e.__traceback__)
+            self.close()
+            raise
+
+    def close(self):
+        for view in (self.view, self.payload, self.buffer):
+            if view is not None:
+                view.release()
+        if self.map is not None:
+            self.map.close()
+        if self.file is not None:
+            self.file.close()
+        self.file = self.map = self.buffer = self.payload = self.view = None
+
+def decode(data) -> list:
+    view = ConversationView(data)
+    try:
+        return view.messages()
+    finally:
+        view.release()
+
+def load_conversation(path) -> list:
+    data = storage.read_file(path)
+    if path.endswith(EXTENSION):
+        return decode(data)
+    return [Message.from_dict(m) for m in pickle.loads(data)]
+
+def convert(directory='conversations'):
+    """Converts the pickled conversations of `directory` to the binary format, keeping the pickles."""
+    for filename in storage.list_files(directory):
+        chat_id = filename.replace('.pkl', '')
+        conversation = load_conversation(f'{directory}/{filename}')
+        storage.write_file(f'{directory}/{chat_id}{EXTENSION}', encode(conversation))
+        print(f'{chat_id}: {len(conversation)} messages')
+
+def map_conversation(path):
+    # Reads every content through the memory map, so its pages count as resident
+    view = ConversationReader(path).__enter__()
+    sum(len(view.content(i)) for i in range(len(view)))
+    return view
+
+def benchmark_paths(directory):
+    chat_ids = [f.replace('.pkl', '') for f in storage.list_files(directory) if os.path.exists(f'{directory}/{f.replace(".pkl", EXTENSION)}')]
+    return {
+        'pickle': ([f'{directory}/{chat_id}.pkl' for chat_id in chat_ids], lambda path: pickle.loads(storage.read_file(path))),
+        'binary': ([f'{directory}/{chat_id}{EXTENSION}' for chat_id in chat_ids], load_conversation),
+        'mapped': ([f'{directory}/{chat_id}{EXTENSION}' for chat_id in chat_ids], map_conversation)
+    }
+
+def measure(label, directory):
+    """Loads every conversation in one format, meant to run in a process of its own so formats don't share a heap."""
+    import psutil
+    paths, load = benchmark_paths(directory)[label]
+    process = psutil.Process()
+    rss = process.memory_info().rss
+    start = time.perf_counter()
+    loaded = [load(path) for path in paths]
+    took = time.perf_counter() - start
+    rss = process.memory_info().rss - rss
+    count = sum(len(c) for c in loaded)
+    del loaded
+    # Python allocations are traced on a second pass, tracing slows down the loading
+    tracemalloc.start()
+    loaded = [load(path) for path in paths]
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    size = sum(os.path.getsize(path) for path in paths)
+    print(f'{label}: {count} messages, {size / 1024:.0f} KiB on disk, loaded in {took * 1000:.1f} ms, RSS +{rss / 1024:.0f} KiB, {traced / 1024:.0f} KiB traced')
+
+def benchmark(directory='conversations'):
+    """Compares size, load time and memory of the pickles against their converted files, fully decoded and memory mapped."""
+    for label in benchmark_paths(directory):
+        subprocess.run([sys.executable, os.path.abspath(__file__), 'measure', label, directory], check=True)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('convert', 'benchmark', 'measure'):
+        print('Usage: python conversation_format.py convert|benchmark')
+    elif sys.argv[1] == 'convert':
+        convert()
+    elif sys.argv[1] == 'measure':
+        measure(sys.argv[2], sys.argv[3])
+    else:
+        benchmark()
@@ -0,0 +1,90 @@
+import os, sys, json, statistics, subprocess, threading, time, urllib.request, urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def start_health_server(port, is_ready):
+    """Serves GET /health on a daemon thread, answering 503 until `is_ready()` is true."""
+    started_at = time.monotonic()
+
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/health':
+                self.send_response(404)
+                self.end_headers()
+                return
+            ready = bool(is_ready())
+            body = json.dumps({"status": "ok", "ready": ready, "uptime": time.monotonic() - started_at}).encode()
+            self.send_response(200 if ready else 503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', port), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Processes whose cold start is measured, the WhatsApp client is left out as it depends on the browser session
+PROCESSES = [('api', 47549), ('bot', 47550)]
+STARTUP_TARGET = 1.0
+
+def import_times(module):
+    """Returns the total import time of `module` and the cumulative time of each module it imports directly, in seconds."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    total, imports = None, {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Imports are indented two spaces for each level of nesting
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == module:
+            total = int(cumulative) / 1e6
+        elif depth == 1:
+            imports[name.strip()] = int(cumulative) / 1e6
+    return total, imports
+
+def cold_start(module, port, timeout=30):
+    """Launches the process and returns how long it took to answer its health check, and to be ready."""
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), f'{module}.py')], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    listening = ready = None
+    try:
+        while ready is None and process.poll() is None and time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(f'http://localhost:{port}/health', timeout=1):
+                    ready = time.perf_counter() - start
+                    listening = listening or ready
+            except urllib.error.HTTPError:
+                # 503 while starting
+                listening = listening or time.perf_counter() - start
+            except OSError:
+                pass
+            time.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait()
+    return listening, ready
+
+def benchmark(runs=3):
+    """Profiles the imports of each process and measures its cold start, run it from the folder the processes use."""
+    for module, port in PROCESSES:
+        total, imports = import_times(module)
+        slowest = sorted(imports.items(), key=lambda item: -item[1])[:5]
+        print(f'{module}: imported in {total * 1000:.0f} ms, slowest imports: ' + ', '.join(f'{name} {took * 1000:.0f} ms' for name, took in slowest))
+        results = [cold_start(module, port) for _ in range(runs)]
+        for label, times in (('listening', [r[0] for r in results]), ('ready', [r[1] for r in results])):
+            if None in times:
+                print(f'{module}: not {label} within the timeout')
+                continue
+            took = statistics.median(times)
+            print(f'{module}: {label} after {took * 1000:.0f} ms (median of {runs}), {"within" if took < STARTUP_TARGET else "over"} the {STARTUP_TARGET:.0f} s target')
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'benchmark':
+        print('Usage: python health.py benchmark')
+    else:
+        benchmark()
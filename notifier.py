@@ -0,0 +1,124 @@
+import asyncio, html, time, logfire
+
+# Messages of the same chat received within this window are sent as a single notification
+COALESCE_WINDOW = 3
+# A notification keeps being edited with new messages of its chat while it is this recent
+OPEN_WINDOW = 120
+# All the notifications go to the same group, where Telegram allows ~20 messages per minute
+MIN_INTERVAL = 3
+MAX_TEXT_LENGTH = 4000
+# A batch that fails to be sent is retried this many times, waiting longer each time, before being dropped
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 5
+
+bot = None
+target_chat_id = None
+queue = None
+pending = {}
+scheduled = set()
+notifications = {}
+failures = {}
+
+def start(telegram_bot, telegram_chat_id):
+    global bot, target_chat_id, queue
+    bot = telegram_bot
+    target_chat_id = telegram_chat_id
+    queue = asyncio.Queue()
+    return asyncio.create_task(worker())
+
+def schedule(chat_id, delay):
+    if chat_id not in scheduled:
+        scheduled.add(chat_id)
+        asyncio.get_running_loop().call_later(delay, queue.put_nowait, chat_id)
+
+def notify(chat_id, message):
+    """Queue an inbound message to be notified. Never waits on Telegram."""
+    if chat_id not in pending:
+        pending[chat_id] = []
+    pending[chat_id].append({
+        "name": message["sender"]["shortName"] or '',
+        "content": message.get("content") or '',
+        "messageId": message["id"].split("_")[2]
+    })
+    schedule(chat_id, COALESCE_WINDOW)
+
+def format_line(message):
+    return f'<b>{html.escape(message["name"])}</b>: <i>{html.escape(message["content"])}</i>'
+
+def complete_keyboard(chat_id, message_id):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    return InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("Complete", callback_data=f'complete_{chat_id}_{message_id}')]
+        ]
+    )
+
+async def edit_notification(chat_id, current, lines, keyboard):
+    from telegram.error import BadRequest
+    text = '\n'.join(current["lines"] + lines)
+    if time.monotonic() - current["updated"] > OPEN_WINDOW or len(text) > MAX_TEXT_LENGTH:
+        return False
+    try:
+        await bot.edit_message_text(text, chat_id=target_chat_id, message_id=current["message_id"], parse_mode='HTML', reply_markup=keyboard)
+    except BadRequest as e:
+        # The notification may have been deleted from the group, send a new one instead
+        logfire.warning("Could not edit telegram notification", chat_id=chat_id, error=e)
+        return False
+    current["lines"] += lines
+    current["updated"] = time.monotonic()
+    return True
+
+async def send(chat_id, messages):
+    from telegram.error import BadRequest
+    lines = [format_line(message) for message in messages]
+    keyboard = complete_keyboard(chat_id, messages[-1]["messageId"])
+    current = notifications.get(chat_id)
+    if current and await edit_notification(chat_id, current, lines, keyboard):
+        logfire.info("Telegram notification updated", chat_id=chat_id, count=len(messages))
+        return
+    result = await bot.send_message(target_chat_id, '\n'.join(lines), parse_mode='HTML', reply_markup=keyboard)
+    notifications[chat_id] = {"message_id": result.message_id, "lines": lines, "updated": time.monotonic()}
+    logfire.info("Telegram notification sent", chat_id=chat_id, count=len(messages))
+    if current:
+        # Only the latest notification of a chat keeps the "Complete" button. The new one is
+        # already sent, so failing here must not send it again.
+        try:
+            await bot.edit_message_reply_markup(chat_id=target_chat_id, message_id=current["message_id"], reply_markup=None)
+        except Exception as e:
+            logfire.warning("Could not remove previous Complete button", chat_id=chat_id, error=e)
+
+async def flush(chat_id):
+    from telegram.error import RetryAfter
+    with logfire.span('notifier.flush', chat_id=chat_id):
+        messages = pending.pop(chat_id, [])
+        if not messages:
+            return
+        try:
+            await send(chat_id, messages)
+            failures.pop(chat_id, None)
+        except RetryAfter as e:
+            # The flood limit applies to the whole group, so the worker waits before any other send
+            logfire.warning("Telegram flood limit reached", chat_id=chat_id, retry_after=e.retry_after)
+            pending[chat_id] = messages + pending.get(chat_id, [])
+            await asyncio.sleep(e.retry_after)
+            schedule(chat_id, 0)
+        except Exception as e:
+            failures[chat_id] = failures.get(chat_id, 0) + 1
+            if failures[chat_id] > MAX_ATTEMPTS:
+                failures.pop(chat_id)
+                logfire.error("Dropping telegram notification after repeated errors", chat_id=chat_id, count=len(messages), error=e)
+                return
+            logfire.warning("Error sending telegram notification, it will be retried", chat_id=chat_id, attempt=failures[chat_id], error=e)
+            # The batch goes back in front of the messages received meanwhile
+            pending[chat_id] = messages + pending.get(chat_id, [])
+            schedule(chat_id, RETRY_DELAY * failures[chat_id])
+
+async def worker():
+    while True:
+        chat_id = await queue.get()
+        scheduled.discard(chat_id)
+        try:
+            await flush(chat_id)
+        except Exception as e:
+            logfire.error("Error sending notification to telegram", chat_id=chat_id, error=e)
+        await asyncio.sleep(MIN_INTERVAL)
@@ -0,0 +1,197 @@
+import os, io, re, zlib, threading, logfire, storage
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+EMBEDDINGS_FOLDER = 'embeddings'
+# Optional sentence-transformers model name. Without it a deterministic hashing embedder is used,
+# which needs no model download and also works offline.
+EMBEDDINGS_MODEL = os.getenv('EMBEDDINGS_MODEL')
+HASH_DIMENSIONS = 512
+
+# Share of the token budget reserved for the most recent messages
+TAIL_SHARE = 0.6
+TOP_K = 8
+QUERY_WEIGHTS = np.array([1.0, 0.5, 0.25], dtype=np.float32)
+# Messages around each retrieved message that are included with it
+EXCHANGE_RADIUS = 1
+# New embeddings are appended to disk as segments, merged into one when there are more than this
+MAX_SEGMENTS = 16
+
+indexes = {}
+locks = {}
+locks_lock = threading.Lock()
+model = None
+# Embeddings are computed in the background on their own thread, so they never hold up the
+# threads used to save conversations
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embeddings')
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+def hash_embed(texts):
+    """Feature hashing of words and word bigrams, deterministic across processes."""
+    vectors = np.zeros((len(texts), HASH_DIMENSIONS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = tokenize(text)
+        for feature in words + [f'{a} {b}' for a, b in zip(words, words[1:])]:
+            h = zlib.crc32(feature.encode('utf-8'))
+            vectors[row, h % HASH_DIMENSIONS] += 1.0 if h & 0x80000000 else -1.0
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def embed(texts):
+    global model
+    if not texts:
+        return np.zeros((0, HASH_DIMENSIONS), dtype=np.float32)
+    if not EMBEDDINGS_MODEL:
+        return hash_embed(texts)
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(EMBEDDINGS_MODEL)
+    return model.encode(texts, batch_size=64, normalize_embeddings=True).astype(np.float32)
+
+def get_lock(chat_id):
+    with locks_lock:
+        if chat_id not in locks:
+            locks[chat_id] = threading.Lock()
+        return locks[chat_id]
+
+def model_name():
+    return EMBEDDINGS_MODEL or 'hash'
+
+def add_vectors(index, ids, vectors):
+    # Rows of messages already in the index are skipped, e.g. a segment written twice by a crash while merging
+    new = [row for row, message_id in enumerate(ids) if message_id not in index["positions"]]
+    if len(new) < len(ids):
+        ids, vectors = [ids[row] for row in new], vectors[new]
+    if not ids:
+        return
+    for message_id in ids:
+        index["positions"][message_id] = len(index["ids"])
+        index["ids"].append(message_id)
+    index["segments"].append(vectors)
+
+def get_vectors(index):
+    """Returns the matrix of every embedding of the index, must be called holding the lock of the chat."""
+    if not index["segments"]:
+        return None
+    if len(index["segments"]) > 1:
+        index["segments"] = [np.concatenate(index["segments"])]
+    return index["segments"][0]
+
+def load_index(chat_id):
+    if chat_id in indexes:
+        return indexes[chat_id]
+    index = {"ids": [], "positions": {}, "segments": [], "files": [], "next": 0}
+    folder = f'{EMBEDDINGS_FOLDER}/{chat_id}'
+    if os.path.isdir(folder):
+        for filename in sorted(storage.list_files(folder, '.npz')):
+            path = f'{folder}/{filename}'
+            index["next"] = max(index["next"], int(os.path.splitext(filename)[0]) + 1)
+            try:
+                data = np.load(io.BytesIO(storage.read_file(path)))
+                # Embeddings from another model can't be compared with the new ones
+                if str(data["model"]) != model_name():
+                    os.remove(path)
+                    continue
+                add_vectors(index, data["ids"].tolist(), data["vectors"])
+                index["files"].append(path)
+            except Exception as e:
+                logfire.error("Error loading embeddings, they will be recomputed", chat_id=chat_id, path=path, error=e)
+    indexes[chat_id] = index
+    return index
+
+def write_segment(chat_id, index, ids, vectors):
+    folder = f'{EMBEDDINGS_FOLDER}/{chat_id}'
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    path = f'{folder}/{index["next"]:08d}.npz'
+    index["next"] += 1
+    buffer = io.BytesIO()
+    np.savez(buffer, ids=np.array(ids), vectors=vectors, model=np.array(model_name()))
+    storage.write_file(path, buffer.getvalue())
+    return path
+
+def save_segment(chat_id, index, ids, vectors):
+    # Only the new embeddings are written, the segments on disk are never rewritten until they are merged
+    index["files"].append(write_segment(chat_id, index, ids, vectors))
+    if len(index["files"]) > MAX_SEGMENTS:
+        with logfire.span('merge_embeddings', chat_id=chat_id, segments=len(index["files"])):
+            merged = write_segment(chat_id, index, index["ids"], get_vectors(index))
+            for path in index["files"]:
+                os.remove(path)
+                if os.path.exists(storage.backup_path(path)):
+                    os.remove(storage.backup_path(path))
+            index["files"] = [merged]
+
+def update_index(chat_id, conversation):
+    """Embeds, in a single batch, the messages of the conversation that aren't embedded yet."""
+    with get_lock(chat_id):
+        index = load_index(chat_id)
+        missing = [m for m in conversation if m.message_id not in index["positions"] and m.content]
+        if not missing:
+            return index
+        with logfire.span('update_embeddings', chat_id=chat_id, count=len(missing)):
+            ids = [m.message_id for m in missing]
+            vectors = embed([m.content for m in missing])
+            add_vectors(index, ids, vectors)
+            save_segment(chat_id, index, ids, vectors)
+        return index
+
+def index_conversation(chat_id, conversation):
+    try:
+        update_index(chat_id, conversation)
+    except Exception as e:
+        logfire.error("Error updating embeddings", chat_id=chat_id, error=e)
+
+def count_tokens(message):
+    # Rough estimation, good enough to keep the prompt within budget
+    return len(message.content or '') // 4 + 4
+
+def select_context(chat_id, conversation, from_message, budget):
+    """Returns the messages to send to the model: the most recent ones plus the older
+    exchanges most similar to them, in chronological order and within `budget` tokens."""
+    with logfire.span('select_context', chat_id=chat_id, budget=budget):
+        history = []
+        for message in conversation:
+            history.append(message)
+            if message.message_id == from_message:
+                break
+        costs = [count_tokens(m) for m in history]
+        if sum(costs) <= budget:
+            return history
+
+        tail_start = len(history)
+        used = 0
+        while tail_start > 0 and (used + costs[tail_start-1] <= budget * TAIL_SHARE or tail_start == len(history)):
+            tail_start -= 1
+            used += costs[tail_start]
+        older, tail = history[:tail_start], history[tail_start:]
+        if not older:
+            return tail
+
+        index = update_index(chat_id, history)
+        with get_lock(chat_id):
+            vectors = get_vectors(index)
+            rows = np.array([index["positions"].get(m.message_id, -1) for m in older])
+        valid = np.flatnonzero(rows >= 0)
+        if len(valid) == 0:
+            return tail
+        # The message being answered weighs the most, the previous ones give some extra context
+        recent = [m.content for m in tail[-3:] if m.content][::-1]
+        query = QUERY_WEIGHTS[:len(recent)] @ embed(recent)
+        scores = vectors[rows[valid]] @ query
+        k = min(TOP_K, len(valid))
+        top = np.argpartition(-scores, k-1)[:k]
+        best = valid[top[np.argsort(-scores[top])]]
+
+        selected = set()
+        for position in best:
+            exchange = [i for i in range(position - EXCHANGE_RADIUS, position + EXCHANGE_RADIUS + 1) if 0 <= i < len(older) and i not in selected]
+            cost = sum(costs[i] for i in exchange)
+            if used + cost > budget:
+                continue
+            selected.update(exchange)
+            used += cost
+        logfire.info("Context selected", retrieved=len(selected), recent=len(tail), tokens=used)
+        return [older[i] for i in sorted(selected)] + tail
@@ -0,0 +1,154 @@
+import asyncio, heapq, itertools, random, re, time, logfire
+import httpx
+
+# Lower value runs first. Completions requested from Telegram are interactive,
+# ingest work (transcriptions, embeddings...) can wait.
+INTERACTIVE = 0
+BACKGROUND = 10
+
+# Requests per second and burst size for each provider. The rate is adapted at runtime
+# from the rate limit headers and 429 responses, never above these values.
+PROVIDERS = {
+    'openai': {'rate': 2.0, 'capacity': 5},
+    'whisper': {'rate': 1.0, 'capacity': 3},
+    'elevenlabs': {'rate': 0.5, 'capacity': 2},
+}
+
+MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+buckets = {}
+counter = itertools.count()
+
+def get_bucket(provider):
+    if provider not in buckets:
+        limits = PROVIDERS[provider]
+        buckets[provider] = {
+            'rate': limits['rate'],
+            'max_rate': limits['rate'],
+            'capacity': limits['capacity'],
+            'tokens': float(limits['capacity']),
+            'updated': time.monotonic(),
+            'blocked_until': 0.0,
+            'waiters': []
+        }
+    return buckets[provider]
+
+def refill(bucket):
+    now = time.monotonic()
+    bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+    bucket['updated'] = now
+    return now
+
+async def acquire(provider, priority):
+    bucket = get_bucket(provider)
+    entry = (priority, next(counter))
+    heapq.heappush(bucket['waiters'], entry)
+    try:
+        while True:
+            now = refill(bucket)
+            if bucket['waiters'][0] != entry:
+                # Someone with a higher priority (or older) is waiting for this provider
+                await asyncio.sleep(0.05)
+            elif now < bucket['blocked_until']:
+                await asyncio.sleep(bucket['blocked_until'] - now)
+            elif bucket['tokens'] < 1:
+                await asyncio.sleep((1 - bucket['tokens']) / bucket['rate'])
+            else:
+                heapq.heappop(bucket['waiters'])
+                bucket['tokens'] -= 1
+                return
+    except BaseException:
+        if entry in bucket['waiters']:
+            bucket['waiters'].remove(entry)
+            heapq.heapify(bucket['waiters'])
+        raise
+
+def parse_duration(value):
+    # Rate limit reset headers look like "1s", "6m0s", "20ms" or a plain number of seconds
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+def update_from_headers(provider, headers):
+    if not headers:
+        return
+    bucket = get_bucket(provider)
+    now = time.monotonic()
+    remaining = headers.get('x-ratelimit-remaining-requests')
+    if remaining is not None:
+        try:
+            remaining = int(remaining)
+        except ValueError:
+            remaining = None
+    if remaining is not None:
+        bucket['tokens'] = min(bucket['tokens'], remaining)
+        if remaining == 0:
+            reset = parse_duration(headers.get('x-ratelimit-reset-requests'))
+            if reset:
+                bucket['blocked_until'] = max(bucket['blocked_until'], now + reset)
+    retry_after = parse_duration(headers.get('retry-after'))
+    if retry_after:
+        bucket['blocked_until'] = max(bucket['blocked_until'], now + retry_after)
+
+def get_status(error):
+    status = getattr(error, 'status_code', None)
+    if status is None and getattr(error, 'response', None) is not None:
+        status = getattr(error.response, 'status_code', None)
+    return status
+
+def get_headers(error):
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'headers', None) is not None:
+        return response.headers
+    return getattr(error, 'headers', None)
+
+def is_retryable(error):
+    # Imported here so processes that never talk to OpenAI don't pay for the SDK import
+    from openai import APIConnectionError
+    if isinstance(error, (httpx.TransportError, APIConnectionError)):
+        return True
+    return get_status(error) in RETRYABLE_STATUS
+
+def backoff(attempt):
+    # Full jitter exponential backoff
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+async def run(provider, func, priority=BACKGROUND, retries=MAX_RETRIES, retry_rate_limits=True):
+    """Run `func` (a coroutine function) against `provider` once a token is available.
+    Retryable errors are retried with jittered exponential backoff, other errors are raised.
+    With `retry_rate_limits` false 429s are raised right away, for callers that can send a smaller request instead."""
+    bucket = get_bucket(provider)
+    attempt = 0
+    while True:
+        await acquire(provider, priority)
+        try:
+            result = await func()
+            # Slowly recover the rate after it was reduced by a 429
+            bucket['rate'] = min(bucket['max_rate'], bucket['rate'] * 1.1)
+            update_from_headers(provider, getattr(result, 'headers', None))
+            return result
+        except Exception as e:
+            update_from_headers(provider, get_headers(e))
+            if get_status(e) == 429 and not retry_rate_limits:
+                # May be a request too large rather than too many requests, the rate is left as is
+                raise
+            if not is_retryable(e) or attempt >= retries:
+                raise
+            if get_status(e) == 429:
+                bucket['rate'] = max(bucket['max_rate'] / 16, bucket['rate'] / 2)
+            delay = backoff(attempt)
+            logfire.warning(f"{provider} call failed, retry {attempt+1}/{retries} in {delay:.1f}s", provider=provider, error=e, status=get_status(e))
+            attempt += 1
+            await asyncio.sleep(delay)
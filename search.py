@@ -0,0 +1,100 @@
+import sqlite3, threading, itertools, html, logfire
+
+DATABASE = 'search.db'
+MAX_RESULTS = 50
+# Messages indexed per transaction when building the index, the lock is released between batches
+BATCH_SIZE = 500
+
+# Snippet markers, replaced by HTML tags once the snippet has been escaped
+MATCH_START = '\x02'
+MATCH_END = '\x03'
+
+connection = None
+lock = threading.Lock()
+
+def get_connection():
+    global connection
+    if connection is None:
+        connection = sqlite3.connect(DATABASE, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(
+                content, name, chat_id UNINDEXED, message_id UNINDEXED, timestamp UNINDEXED, from_me UNINDEXED,
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        connection.execute('CREATE TABLE IF NOT EXISTS indexed (message_id TEXT PRIMARY KEY)')
+    return connection
+
+def add_message(db, chat_id, message):
+    # The FTS table can't have a unique constraint, so indexed ids are tracked apart
+    if db.execute('INSERT OR IGNORE INTO indexed (message_id) VALUES (?)', (message.message_id,)).rowcount == 0:
+        return False
+    db.execute(
+        'INSERT INTO messages (content, name, chat_id, message_id, timestamp, from_me) VALUES (?, ?, ?, ?, ?, ?)',
+        (message.content or '', message.name or '', chat_id, message.message_id, message.timestamp, int(message.from_me))
+    )
+    return True
+
+def index_message(chat_id, message):
+    with logfire.span('search.index_message', chat_id=chat_id):
+        try:
+            with lock:
+                db = get_connection()
+                with db:
+                    add_message(db, chat_id, message)
+        except Exception as e:
+            logfire.error("Error indexing message", chat_id=chat_id, error=e)
+
+def index_conversations(conversations):
+    """Indexes the messages that are not in the index yet, used to build it from existing history.
+    `conversations` are pairs of chat id and messages, e.g. the items of a dict."""
+    with logfire.span('search.index_conversations'):
+        try:
+            count = 0
+            for chat_id, conversation in conversations:
+                for batch in itertools.batched(conversation, BATCH_SIZE):
+                    with lock:
+                        db = get_connection()
+                        with db:
+                            count += sum(add_message(db, chat_id, message) for message in batch)
+            logfire.info("Conversations indexed successfully", count=count)
+            return count
+        except Exception as e:
+            logfire.error("Error indexing conversations", error=e)
+            return 0
+
+def format_query(query):
+    # Every word is quoted so user input can't be parsed as FTS5 syntax, the last one matches as a prefix
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+def search(query, limit=10):
+    match = format_query(query)
+    if not match:
+        return []
+    # A negative limit means no limit at all in SQLite
+    limit = max(1, min(limit, MAX_RESULTS))
+    with lock:
+        rows = get_connection().execute(
+            """
+            SELECT chat_id, message_id, name, timestamp, from_me, snippet(messages, 0, ?, ?, '…', 16), bm25(messages)
+            FROM messages WHERE messages MATCH ? ORDER BY bm25(messages) LIMIT ?
+            """,
+            (MATCH_START, MATCH_END, match, limit)
+        ).fetchall()
+    return [
+        {
+            "chatId": chat_id,
+            "messageId": message_id,
+            "name": name,
+            "timestamp": timestamp,
+            "fromMe": bool(from_me),
+            "snippet": html.escape(snippet).replace(MATCH_START, '<b>').replace(MATCH_END, '</b>'),
+            "score": -score
+        }
+        for chat_id, message_id, name, timestamp, from_me, snippet, score in rows
+    ]
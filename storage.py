@@ -0,0 +1,179 @@
+import os, asyncio, pickle, struct, tempfile, zlib, logfire
+
+# Every file is written as a record: magic, crc32 and length of the payload, then the payload.
+# Files written before this format existed are plain pickles and are still readable.
+MAGIC = b'WAR1'
+HEADER = struct.Struct('<4sIQ')
+# Saves requested within this window are written and fsynced together
+COMMIT_DELAY = 0.01
+
+class CorruptedFile(Exception):
+    pass
+
+pending = {}
+waiters = []
+committer = None
+
+def encode_record(payload: bytes) -> bytes:
+    return HEADER.pack(MAGIC, zlib.crc32(payload), len(payload)) + payload
+
+def verify_record(data: memoryview) -> memoryview:
+    """Checks a record without copying it, returns a view of its payload (the whole data for legacy files)."""
+    if data[:len(MAGIC)] != MAGIC:
+        return data
+    if len(data) < HEADER.size:
+        raise CorruptedFile('Truncated header')
+    _, checksum, length = HEADER.unpack_from(data)
+    payload = data[HEADER.size:]
+    if len(payload) != length:
+        raise CorruptedFile(f'Expected {length} bytes, found {len(payload)}')
+    if zlib.crc32(payload) != checksum:
+        raise CorruptedFile('Checksum mismatch')
+    return payload
+
+def decode_record(data: bytes) -> bytes:
+    """Returns the payload of a record, or the data itself for legacy files."""
+    if not data.startswith(MAGIC):
+        return data
+    with memoryview(data) as view:
+        return bytes(verify_record(view))
+
+def backup_path(path):
+    return f'{path}.bak'
+
+def fsync_directory(directory):
+    # Makes the renames durable, not supported on Windows where it isn't needed
+    try:
+        fd = os.open(directory or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_temporary(path, data: bytes):
+    # Every write gets its own temporary file, so concurrent writers of a path never share one
+    directory, name = os.path.split(path)
+    fd, temporary = tempfile.mkstemp(prefix=f'.{name}.', suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(encode_record(data))
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(temporary)
+        raise
+    return temporary
+
+def replace(temporary, path):
+    # The previous version is kept as a backup through a hard link, so `path` always exists
+    if os.path.exists(path):
+        try:
+            link = f'{temporary}.bak'
+            os.link(path, link)
+            os.replace(link, backup_path(path))
+            # Renaming onto another link of the same file does nothing, e.g. when two writers race
+            if os.path.exists(link):
+                os.remove(link)
+        except OSError as e:
+            logfire.warning("Could not keep a backup", path=path, error=e)
+    os.replace(temporary, path)
+
+def commit(batch):
+    """Writes every file of the batch to a temporary file, fsyncs them and renames them into place."""
+    with logfire.span('storage.commit', count=len(batch)):
+        errors = {}
+        temporaries = {}
+        for path, data in batch.items():
+            try:
+                temporaries[path] = write_temporary(path, data)
+            except Exception as e:
+                errors[path] = e
+        for path, temporary in temporaries.items():
+            try:
+                replace(temporary, path)
+            except Exception as e:
+                errors[path] = e
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+        for directory in {os.path.dirname(path) for path in temporaries}:
+            fsync_directory(directory)
+        return errors
+
+def write_file(path, data: bytes):
+    """Atomically and durably replaces `path`, for synchronous callers."""
+    errors = commit({path: data})
+    if path in errors:
+        raise errors[path]
+
+async def run_committer():
+    global committer
+    try:
+        while pending:
+            await asyncio.sleep(COMMIT_DELAY)
+            batch = dict(pending)
+            batch_waiters = list(waiters)
+            pending.clear()
+            waiters.clear()
+            try:
+                errors = await asyncio.to_thread(commit, batch)
+            except Exception as e:
+                errors = {path: e for path in batch}
+            for path, future in batch_waiters:
+                if future.done():
+                    continue
+                if path in errors:
+                    future.set_exception(errors[path])
+                else:
+                    future.set_result(None)
+    finally:
+        committer = None
+
+async def save(path, data: bytes):
+    """Atomically and durably replaces `path`. Concurrent saves share a single commit,
+    and only the latest data of each path is written."""
+    global committer
+    future = asyncio.get_running_loop().create_future()
+    pending[path] = data
+    waiters.append((path, future))
+    if committer is None:
+        committer = asyncio.create_task(run_committer())
+    await future
+
+async def save_pickle(path, obj):
+    await save(path, pickle.dumps(obj))
+
+def save_pickle_sync(path, obj):
+    write_file(path, pickle.dumps(obj))
+
+def read_file(path) -> bytes:
+    """Reads a file written by this module, falling back to its backup if it is corrupted."""
+    try:
+        with open(path, 'rb') as f:
+            return decode_record(f.read())
+    except CorruptedFile as e:
+        if not os.path.exists(backup_path(path)):
+            raise
+        logfire.warning("File corrupted, recovering from backup", path=path, error=e)
+        with open(backup_path(path), 'rb') as f:
+            return decode_record(f.read())
+
+def load_pickle(path):
+    try:
+        return pickle.loads(read_file(path))
+    except (CorruptedFile, FileNotFoundError):
+        raise
+    except Exception as e:
+        # A legacy pickle truncated by a crash, the backup may still be good
+        if not os.path.exists(backup_path(path)):
+            raise
+        logfire.warning("File could not be unpickled, recovering from backup", path=path, error=e)
+        with open(backup_path(path), 'rb') as f:
+            return pickle.loads(decode_record(f.read()))
+
+def list_files(directory, extension='.pkl'):
+    # Temporary files and backups are skipped
+    return [name for name in os.listdir(directory) if name.endswith(extension) and not name.startswith('.')]
@@ -0,0 +1,193 @@
+import os, re, sys, time, threading, logfire, storage, retrieval, conversation_format
+from collections import Counter, deque
+
+STYLES_FOLDER = 'styles'
+# Below this amount of own messages the profile isn't reliable enough to replace the history
+MIN_PROFILE_MESSAGES = 20
+MAX_NGRAMS = 2000
+EXAMPLES = 8
+
+EMOJI = re.compile('[\U0001F300-\U0001FAFF☀-➿]')
+
+profiles = {}
+# Profiles are built, updated and rendered from worker threads, one at a time for each chat
+locks = {}
+locks_lock = threading.Lock()
+
+def get_lock(chat_id):
+    with locks_lock:
+        if chat_id not in locks:
+            locks[chat_id] = threading.Lock()
+        return locks[chat_id]
+
+def new_profile():
+    return {
+        "count": 0,
+        "words": 0,
+        "lowercase_start": 0,
+        "emojis": 0,
+        "endings": Counter(),
+        "openers": Counter(),
+        "ngrams": Counter(),
+        "recent": deque(maxlen=200),
+        "message_ids": set()
+    }
+
+def update_profile(profile, message):
+    if not message.from_me or not message.content or message.message_id in profile["message_ids"]:
+        return False
+    content = message.content.strip()
+    words = re.findall(r'\w+', content.lower())
+    profile["message_ids"].add(message.message_id)
+    profile["count"] += 1
+    profile["words"] += len(words)
+    profile["lowercase_start"] += content[:1].islower()
+    profile["emojis"] += bool(EMOJI.search(content))
+    last = content[-1:]
+    profile["endings"]["emoji" if EMOJI.match(last) else last if last in '.!?' else "nothing"] += 1
+    if words:
+        profile["openers"][words[0]] += 1
+    for n in (2, 3):
+        profile["ngrams"].update(' '.join(words[i:i+n]) for i in range(len(words) - n + 1))
+    if len(profile["ngrams"]) > MAX_NGRAMS * 2:
+        # Keep the counter bounded, rare n-grams will never be shown anyway
+        profile["ngrams"] = Counter(dict(profile["ngrams"].most_common(MAX_NGRAMS)))
+    profile["recent"].append(content)
+    return True
+
+def build_profile(conversation):
+    profile = new_profile()
+    for message in conversation:
+        update_profile(profile, message)
+    return profile
+
+def load_profile(chat_id):
+    path = f'{STYLES_FOLDER}/{chat_id}.pkl'
+    if os.path.exists(path):
+        try:
+            return storage.load_pickle(path)
+        except Exception as e:
+            logfire.error("Error loading style profile, it will be rebuilt", chat_id=chat_id, error=e)
+    return None
+
+def save_profile(chat_id, profile):
+    with logfire.span('save_style_profile', chat_id=chat_id):
+        try:
+            if not os.path.exists(STYLES_FOLDER):
+                os.makedirs(STYLES_FOLDER)
+            storage.save_pickle_sync(f'{STYLES_FOLDER}/{chat_id}.pkl', profile)
+        except Exception as e:
+            logfire.error("Error saving style profile", chat_id=chat_id, error=e)
+
+def get_profile(chat_id, conversation):
+    # Must be called holding the lock of the chat
+    if chat_id not in profiles:
+        profile = load_profile(chat_id)
+        if profile is None:
+            profile = build_profile(conversation)
+            save_profile(chat_id, profile)
+        profiles[chat_id] = profile
+    return profiles[chat_id]
+
+def update(chat_id, conversation, message):
+    """Refreshes the profile of the chat with a new message, only own messages count."""
+    with get_lock(chat_id):
+        profile = get_profile(chat_id, conversation)
+        if update_profile(profile, message):
+            save_profile(chat_id, profile)
+
+def pick_examples(profile):
+    # Messages of typical length are the most representative ones
+    recent = list(dict.fromkeys(profile["recent"]))
+    average = profile["words"] / max(1, profile["count"])
+    recent.sort(key=lambda content: abs(len(content.split()) - average))
+    return recent[:EXAMPLES]
+
+def render_profile(profile):
+    count = profile["count"]
+    ending, _ = profile["endings"].most_common(1)[0]
+    phrases = [ngram for ngram, times in profile["ngrams"].most_common(12) if times > 1]
+    openers = [word for word, times in profile["openers"].most_common(5) if times > 1]
+    lines = [
+        f"Writing style of User 1 in this chat, learned from {count} of their messages:",
+        f"- Messages have {profile['words'] / count:.0f} words on average.",
+        f"- {100 * profile['lowercase_start'] / count:.0f}% start with a lowercase letter, most of them end with {'no punctuation' if ending == 'nothing' else ending}.",
+        f"- {100 * profile['emojis'] / count:.0f}% contain emojis."
+    ]
+    if openers:
+        lines.append(f"- Frequent first words: {', '.join(openers)}.")
+    if phrases:
+        lines.append(f"- Frequent expressions: {', '.join(phrases)}.")
+    lines.append("- Examples of User 1 messages:")
+    lines += [f'  "{example}"' for example in pick_examples(profile)]
+    return '\n'.join(lines)
+
+def get_style_prompt(chat_id, conversation):
+    """Returns the rendered profile, or None if there aren't enough own messages yet."""
+    with logfire.span('get_style_prompt', chat_id=chat_id):
+        try:
+            with get_lock(chat_id):
+                profile = get_profile(chat_id, conversation)
+                if profile["count"] < MIN_PROFILE_MESSAGES:
+                    return None
+                return render_profile(profile)
+        except Exception as e:
+            logfire.error("Error rendering style profile", chat_id=chat_id, error=e)
+            return None
+
+def rebuild(directory='conversations'):
+    """Rebuilds every profile from the stored conversations, run `python conversation_format.py convert` first for old pickles."""
+    for filename in storage.list_files(directory, conversation_format.EXTENSION):
+        chat_id = os.path.splitext(filename)[0]
+        with conversation_format.ConversationReader(f'{directory}/{filename}') as view:
+            profile = build_profile(view)
+        save_profile(chat_id, profile)
+        print(f'{chat_id}: {profile["count"]} messages')
+
+def benchmark(directory='conversations', runs=5):
+    """Compares, for every stored chat with a profile, the prompt sent without it against the one sent with it.
+    Nothing is sent to the model, latency is the time spent building the prompt."""
+    from api import CONTEXT_TOKEN_BUDGET, STYLE_CONTEXT_TOKEN_BUDGET
+    totals = {}
+    for filename in storage.list_files(directory, conversation_format.EXTENSION):
+        chat_id = os.path.splitext(filename)[0]
+        conversation = conversation_format.load_conversation(f'{directory}/{filename}')
+        if not conversation:
+            continue
+        from_message = conversation[-1].message_id
+        def history():
+            return None, conversation
+        def without_profile():
+            return None, retrieval.select_context(chat_id, conversation, from_message, CONTEXT_TOKEN_BUDGET)
+        def with_profile():
+            style_prompt = get_style_prompt(chat_id, conversation)
+            if style_prompt is None:
+                return None, None
+            return style_prompt, retrieval.select_context(chat_id, conversation, from_message, STYLE_CONTEXT_TOKEN_BUDGET)
+        # The first completion of a chat also builds its profile and embeddings
+        start = time.perf_counter()
+        if with_profile()[1] is None:
+            continue
+        first = time.perf_counter() - start
+        for label, build in (('whole history', history), ('history within budget', without_profile), ('profile and recent context', with_profile)):
+            start = time.perf_counter()
+            for _ in range(runs):
+                style_prompt, context = build()
+            took = (time.perf_counter() - start) / runs
+            tokens = sum(retrieval.count_tokens(m) for m in context) + len(style_prompt or '') // 4
+            total = totals.setdefault(label, [0, 0, 0])
+            total[0] += 1
+            total[1] += tokens
+            total[2] += took
+            print(f'{chat_id} {label}: {len(context)} messages, ~{tokens} tokens, built in {took * 1000:.1f} ms')
+        print(f'{chat_id} first completion with profile: built in {first * 1000:.1f} ms')
+    for label, (chats, tokens, took) in totals.items():
+        print(f'average {label}: ~{tokens / chats:.0f} tokens, built in {took / chats * 1000:.1f} ms')
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('rebuild', 'benchmark'):
+        print('Usage: python style.py rebuild|benchmark')
+    elif sys.argv[1] == 'rebuild':
+        rebuild()
+    else:
+        benchmark()
@@ -0,0 +1,9 @@
+import os, sys, pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The modules keep their data in folders relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,42 @@
+import asyncio, types, httpx, pytest
+from openai import RateLimitError
+from conversation_format import Message
+
+CHAT_ID = '34600000001'
+
+class FakeCompletions:
+    """Rejects prompts above `max_messages` like OpenAI does with requests too large."""
+
+    def __init__(self, max_messages):
+        self.max_messages = max_messages
+        self.prompts = []
+        self.with_raw_response = self
+
+    async def create(self, model, messages):
+        self.prompts.append(messages)
+        if len(messages) > self.max_messages:
+            request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+            raise RateLimitError('Request too large', response=httpx.Response(429, request=request), body=None)
+        completion = types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content='vale!'))])
+        return types.SimpleNamespace(headers={}, parse=lambda: completion)
+
+@pytest.fixture
+def api(workdir, monkeypatch):
+    import api, retrieval, style, scheduler
+    monkeypatch.setenv('OPENAI_MODEL', 'gpt-4o')
+    monkeypatch.setattr(retrieval, 'EMBEDDINGS_MODEL', None)
+    monkeypatch.setattr(retrieval, 'indexes', {})
+    monkeypatch.setattr(style, 'profiles', {})
+    monkeypatch.setattr(scheduler, 'buckets', {})
+    conversation = [Message(CHAT_ID, False, 'Ana', f'mensaje número {i} de la conversación', f'm{i}', 1000 + i) for i in range(2000)]
+    monkeypatch.setattr(api, 'conversations', {CHAT_ID: conversation})
+    return api
+
+def test_request_too_large_goes_straight_to_a_smaller_context(api, monkeypatch):
+    completions = FakeCompletions(max_messages=500)
+    monkeypatch.setattr(api, 'get_openai', lambda: types.SimpleNamespace(chat=types.SimpleNamespace(completions=completions)))
+    assert asyncio.run(api.complete_conversation(CHAT_ID, 'm1999')) == 'vale!'
+    # One attempt with the whole budget, then one with a quarter of it
+    assert len(completions.prompts) == 2
+    assert len(completions.prompts[1]) < len(completions.prompts[0]) / 3
+    assert api.scheduler.buckets['openai']['rate'] == api.scheduler.PROVIDERS['openai']['rate']
@@ -0,0 +1,38 @@
+import os, pytest
+import storage, conversation_format
+from conversation_format import Message, ConversationReader
+
+PATH = f'34600000001{conversation_format.EXTENSION}'
+
+def conversation(count):
+    return [Message(f'3460000000{i % 2}', i % 2 == 0, 'Ana María' if i % 2 else '', f'¿qué tal? 😂 {i}' * (i % 3), f'3EB0{i:04X}', 1700000000 + i) for i in range(count)]
+
+def fields(messages):
+    return [(m.sender, m.from_me, m.name, m.content, m.message_id, m.timestamp) for m in messages]
+
+def test_round_trip(workdir):
+    messages = conversation(50)
+    storage.write_file(PATH, conversation_format.encode(messages))
+    assert fields(conversation_format.load_conversation(PATH)) == fields(messages)
+    with ConversationReader(PATH) as view:
+        assert fields(view) == fields(messages)
+        assert view.content(4) == messages[4].content
+    assert fields(conversation_format.decode(conversation_format.encode([]))) == []
+
+@pytest.mark.parametrize('size', [0, 10, 30, 500])
+def test_corrupted_file_raises_corrupted_file(workdir, size):
+    storage.write_file(PATH, conversation_format.encode(conversation(50)))
+    with open(PATH, 'r+b') as f:
+        f.truncate(size)
+    with pytest.raises(storage.CorruptedFile):
+        with ConversationReader(PATH):
+            pass
+
+def test_corrupted_file_falls_back_to_backup(workdir):
+    storage.write_file(PATH, conversation_format.encode(conversation(50)))
+    storage.write_file(PATH, conversation_format.encode(conversation(60)))
+    with open(PATH, 'r+b') as f:
+        f.truncate(os.path.getsize(PATH) // 2)
+    with ConversationReader(PATH) as view:
+        assert len(view) == 50
+    assert len(conversation_format.load_conversation(PATH)) == 50
@@ -0,0 +1,112 @@
+import asyncio, base64, random, pytest
+
+# More than fit in any window of recent messages, so redeliveries of old ones are covered
+MESSAGES = 80
+
+@pytest.fixture
+def api(workdir, monkeypatch):
+    import api, search, retrieval, style
+    monkeypatch.setattr(search, 'connection', None)
+    monkeypatch.setattr(api, 'conversation_files', {})
+    monkeypatch.setattr(api, 'conversations', {})
+    monkeypatch.setattr(api, 'samples', {})
+    monkeypatch.setattr(api, 'message_ids', {})
+    monkeypatch.setattr(api, 'chat_locks', {})
+    monkeypatch.setattr(api, 'embedding_tasks', {})
+    monkeypatch.setattr(api, 'embeddings_outdated', set())
+    monkeypatch.setattr(retrieval, 'indexes', {})
+    monkeypatch.setattr(style, 'profiles', {})
+    monkeypatch.setattr(api.notifier, 'notify', lambda chat_id, message: None)
+    for folder in ('conversations', 'samples', 'audios'):
+        (workdir / folder).mkdir(exist_ok=True)
+    api.ready.set()
+    return api
+
+def new_message(chat_id, message_id, t, content=None, audio=False, from_me=False):
+    message = {
+        "id": f"false_{chat_id}@c.us_{message_id}",
+        "chatId": {"user": chat_id},
+        "from": f"{chat_id}@c.us",
+        "fromMe": from_me,
+        "sender": {"shortName": "Contact"},
+        "content": content,
+        "t": t
+    }
+    if audio:
+        message["base_64_audio"] = "data:audio/ogg; codecs=opus;base64," + base64.b64encode(voice_note(f"voice note {message_id}")).decode()
+    return message
+
+def voice_note(text, seconds=2):
+    # Just enough of an Ogg Opus stream for the codec and duration to be read, carrying `text` as its audio
+    head = b'OggS\x00\x02' + bytes(8) + bytes(13) + b'OpusHead\x01\x01' + (312).to_bytes(2, 'little') + bytes(7)
+    last = b'OggS\x00\x04' + (312 + seconds * 48000).to_bytes(8, 'little') + bytes(13)
+    return head + b'|' + text.encode() + b'|' + last
+
+class SlowTranscriber:
+    """Stands in for Whisper, taking a random time so transcriptions finish out of order."""
+
+    def __init__(self):
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, audio):
+        self.calls.append(audio["data"])
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(random.uniform(0.05, 0.3))
+        finally:
+            self.running -= 1
+        return audio["data"].split(b'|')[1].decode()
+
+def test_interleaved_messages_are_stored_in_order(api, monkeypatch):
+    import conversation_format
+    random.seed(1)
+    transcriber = SlowTranscriber()
+    monkeypatch.setattr(api, 'transcribe_audio', transcriber)
+    chats = ['34600000001', '34600000002', '34600000003']
+    messages = []
+    for chat_id in chats:
+        for i in range(MESSAGES):
+            messages.append(new_message(chat_id, f'{chat_id}-{i}', 1000 + i, content=f'text {i}', audio=i % 3 == 0, from_me=i % 4 == 0))
+    # Redeliveries, some of them while the original is still being transcribed
+    redelivered = [dict(m) for m in random.sample(messages, 20)]
+
+    async def run():
+        shuffled = random.sample(messages, len(messages))
+        await asyncio.gather(*[api.new_message(dict(m)) for m in shuffled + redelivered])
+        # A resync after a restart sends old messages again
+        await asyncio.gather(*[api.new_message(dict(m)) for m in messages[:10]])
+
+    asyncio.run(run())
+
+    audios = [m for m in messages if m.get("base_64_audio")]
+    assert len(transcriber.calls) == len(audios)
+    # Transcriptions of every chat ran at the same time instead of one after the other
+    assert transcriber.max_running > len(chats)
+    for chat_id in chats:
+        stored = api.conversations[chat_id]
+        ids = [m.message_id for m in stored]
+        assert len(ids) == len(set(ids)) == MESSAGES
+        assert [m.timestamp for m in stored] == sorted(m.timestamp for m in stored)
+        assert ids == [f'{chat_id}-{i}' for i in range(MESSAGES)]
+        assert stored[3].content == f'voice note {chat_id}-3'
+        on_disk = conversation_format.load_conversation(f'conversations/{chat_id}{conversation_format.EXTENSION}')
+        assert [m.message_id for m in on_disk] == ids
+    for telephone, samples in api.samples.items():
+        assert len(samples) == len(set(samples))
+
+def test_failed_message_can_be_received_again(api, monkeypatch):
+    async def failing(audio):
+        raise RuntimeError('Whisper is down')
+    message = new_message('34600000001', 'voice', 1000, audio=True)
+
+    async def run():
+        monkeypatch.setattr(api, 'transcribe_audio', failing)
+        assert (await api.new_message(dict(message)))["error"]
+        monkeypatch.setattr(api, 'transcribe_audio', SlowTranscriber())
+        return await api.new_message(dict(message))
+
+    assert asyncio.run(run()) == {"message": "Message received"}
+    assert [m.message_id for m in api.conversations['34600000001']] == ['voice']
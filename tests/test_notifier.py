@@ -0,0 +1,102 @@
+import asyncio, types, pytest
+from telegram.error import RetryAfter
+import notifier
+
+CHAT_ID = '34600000001'
+
+class RecordingBot:
+    """Records what is sent to Telegram, raising the given errors on the first sends."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+        self.texts = {}
+
+    async def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
+        if self.errors:
+            raise self.errors.pop(0)
+        message_id = len(self.texts) + 1
+        self.texts[message_id] = text
+        self.calls.append(('send', message_id, text, button(reply_markup)))
+        return types.SimpleNamespace(message_id=message_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, parse_mode=None, reply_markup=None):
+        self.texts[message_id] = text
+        self.calls.append(('edit', message_id, text, button(reply_markup)))
+
+    async def edit_message_reply_markup(self, chat_id=None, message_id=None, reply_markup=None):
+        self.calls.append(('remove button', message_id, None, button(reply_markup)))
+
+def button(reply_markup):
+    # The message the "Complete" button answers to
+    if reply_markup is None:
+        return None
+    return reply_markup.inline_keyboard[0][0].callback_data.split('_')[-1]
+
+def message(message_id, content):
+    return {"id": f"false_{CHAT_ID}@c.us_{message_id}", "sender": {"shortName": "Ana <3"}, "content": content}
+
+@pytest.fixture(autouse=True)
+def fast(monkeypatch):
+    for name, value in (('COALESCE_WINDOW', 0.01), ('MIN_INTERVAL', 0), ('RETRY_DELAY', 0.01)):
+        monkeypatch.setattr(notifier, name, value)
+    for name in ('pending', 'notifications', 'failures'):
+        monkeypatch.setattr(notifier, name, {})
+    monkeypatch.setattr(notifier, 'scheduled', set())
+
+def run(bot, *bursts, wait=0.1):
+    """Notifies each burst of messages, waiting for it to be sent before the next one."""
+    async def main():
+        worker = notifier.start(bot, 'group')
+        for burst in bursts:
+            for m in burst:
+                notifier.notify(CHAT_ID, m)
+            await asyncio.sleep(wait)
+        worker.cancel()
+    asyncio.run(main())
+
+def test_burst_is_sent_as_one_notification():
+    bot = RecordingBot()
+    run(bot, [message('a', 'hola'), message('b', None), message('c', '1 < 2 & 3')])
+    assert [(action, button) for action, _, _, button in bot.calls] == [('send', 'c')]
+    assert bot.texts[1].count('Ana &lt;3') == 3
+    assert '1 &lt; 2 &amp; 3' in bot.texts[1]
+
+def test_later_burst_edits_the_open_notification():
+    bot = RecordingBot()
+    run(bot, [message('a', 'hola')], [message('b', '¿qué tal?'), message('c', 'todo bien')])
+    assert [(action, message_id, button) for action, message_id, _, button in bot.calls] == [('send', 1, 'a'), ('edit', 1, 'c')]
+    assert [line.split(': ')[1] for line in bot.texts[1].split('\n')] == ['<i>hola</i>', '<i>¿qué tal?</i>', '<i>todo bien</i>']
+
+def test_new_notification_once_the_open_one_is_old(monkeypatch):
+    monkeypatch.setattr(notifier, 'OPEN_WINDOW', 0.05)
+    bot = RecordingBot()
+    run(bot, [message('a', 'hola')], [message('b', '¿sigues ahí?')])
+    # Only the newest notification keeps the "Complete" button
+    assert [(action, message_id, button) for action, message_id, _, button in bot.calls] == [('send', 1, 'a'), ('send', 2, 'b'), ('remove button', 1, None)]
+    assert 'hola' not in bot.texts[2]
+
+def test_new_notification_once_the_open_one_is_too_long(monkeypatch):
+    monkeypatch.setattr(notifier, 'MAX_TEXT_LENGTH', 60)
+    bot = RecordingBot()
+    run(bot, [message('a', 'hola')], [message('b', 'un mensaje bastante más largo que el anterior')])
+    assert [(action, message_id, button) for action, message_id, _, button in bot.calls] == [('send', 1, 'a'), ('send', 2, 'b'), ('remove button', 1, None)]
+
+def test_flood_limit_requeues_the_batch():
+    bot = RecordingBot(RetryAfter(0.05))
+    run(bot, [message('a', 'hola'), message('b', 'adiós')], wait=0.3)
+    assert [(action, button) for action, _, _, button in bot.calls] == [('send', 'b')]
+    assert 'hola' in bot.texts[1] and 'adiós' in bot.texts[1]
+    assert notifier.failures == {}
+
+def test_batch_is_retried_after_an_error():
+    bot = RecordingBot(TimeoutError('Timed out'), TimeoutError('Timed out'))
+    run(bot, [message('a', 'hola'), message('b', 'adiós')], wait=0.3)
+    assert [(action, button) for action, _, _, button in bot.calls] == [('send', 'b')]
+    assert 'hola' in bot.texts[1] and 'adiós' in bot.texts[1]
+
+def test_batch_is_dropped_after_repeated_errors():
+    bot = RecordingBot(*[TimeoutError('Timed out')] * 100)
+    run(bot, [message('a', 'hola')], wait=1)
+    assert bot.calls == []
+    assert notifier.pending == {} and notifier.failures == {}
@@ -0,0 +1,61 @@
+import os, pytest
+import numpy as np
+import retrieval
+from conversation_format import Message
+
+CHAT_ID = '34600000001'
+
+@pytest.fixture(autouse=True)
+def hashing_embedder(workdir, monkeypatch):
+    # The deterministic embedder needs no model, so these tests run offline
+    monkeypatch.setattr(retrieval, 'EMBEDDINGS_MODEL', None)
+    monkeypatch.setattr(retrieval, 'indexes', {})
+
+def chat(count, seed=1):
+    rng = np.random.default_rng(seed)
+    vocabulary = [f'palabra{i}' for i in range(300)]
+    return [
+        Message(CHAT_ID, i % 3 == 0, 'Ana', ' '.join(rng.choice(vocabulary, 12)), f'm{i}', 1000 + i)
+        for i in range(count)
+    ]
+
+def test_select_context(workdir):
+    conversation = chat(400)
+    conversation[40].content = 'la receta de la paella lleva arroz bomba y azafrán de verdad'
+    conversation[-1].content = '¿me pasas la receta de la paella con azafrán?'
+    budget = 800
+    context = retrieval.select_context(CHAT_ID, conversation, conversation[-1].message_id, budget)
+
+    assert sum(retrieval.count_tokens(m) for m in context) <= budget
+    timestamps = [m.timestamp for m in context]
+    assert timestamps == sorted(timestamps) and len(set(timestamps)) == len(timestamps)
+    # The most recent messages are kept as they are, up to the message being answered
+    tail = conversation[-retrieval.TOP_K:]
+    assert context[-len(tail):] == tail
+    # The old message is retrieved by similarity together with its neighbours
+    assert conversation[40] in context
+    assert conversation[39] in context and conversation[41] in context
+    assert len(context) < len(conversation)
+
+def test_short_conversation_is_sent_whole(workdir):
+    conversation = chat(10)
+    assert retrieval.select_context(CHAT_ID, conversation, 'm5', 10000) == conversation[:6]
+
+def test_embeddings_are_appended_on_disk(workdir, monkeypatch):
+    monkeypatch.setattr(retrieval, 'MAX_SEGMENTS', 3)
+    conversation = chat(50)
+    retrieval.update_index(CHAT_ID, conversation[:30])
+    first = sorted(os.listdir(f'embeddings/{CHAT_ID}'))
+    for end in range(31, 34):
+        retrieval.update_index(CHAT_ID, conversation[:end])
+    # Each update wrote a small segment, until they were merged into one
+    files = [f for f in os.listdir(f'embeddings/{CHAT_ID}') if not f.endswith('.bak')]
+    assert first == ['00000000.npz'] and files == ['00000004.npz']
+    retrieval.update_index(CHAT_ID, conversation)
+
+    in_memory = retrieval.indexes[CHAT_ID]
+    monkeypatch.setattr(retrieval, 'indexes', {})
+    loaded = retrieval.load_index(CHAT_ID)
+    assert loaded["ids"] == in_memory["ids"] == [m.message_id for m in conversation]
+    assert np.array_equal(retrieval.get_vectors(loaded), retrieval.get_vectors(in_memory))
+    assert np.allclose(retrieval.get_vectors(loaded), retrieval.embed([m.content for m in conversation]))
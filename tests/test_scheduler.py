@@ -0,0 +1,121 @@
+import asyncio, time, pytest
+import scheduler
+
+class ProviderError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f'HTTP {status_code}')
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class FakeProvider:
+    """Answers with the given errors first, then succeeds, recording every call."""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = []
+
+    async def __call__(self):
+        self.calls.append(time.monotonic())
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+@pytest.fixture(autouse=True)
+def fake_provider(monkeypatch):
+    monkeypatch.setattr(scheduler, 'PROVIDERS', {'fake': {'rate': 20.0, 'capacity': 1}})
+    monkeypatch.setattr(scheduler, 'buckets', {})
+    monkeypatch.setattr(scheduler, 'BASE_DELAY', 0.01)
+
+def test_interactive_calls_go_first():
+    order = []
+    def call(label):
+        async def func():
+            order.append(label)
+        return func
+
+    async def main():
+        # The only token is taken, everyone has to queue
+        await scheduler.acquire('fake', scheduler.BACKGROUND)
+        background = [asyncio.create_task(scheduler.run('fake', call(f'background {i}'))) for i in range(3)]
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(scheduler.run('fake', call('interactive'), priority=scheduler.INTERACTIVE))
+        await asyncio.gather(*background, interactive)
+
+    asyncio.run(main())
+    assert order == ['interactive', 'background 0', 'background 1', 'background 2']
+
+def test_bucket_limits_throughput():
+    provider = FakeProvider()
+
+    async def main():
+        await asyncio.gather(*[scheduler.run('fake', provider) for _ in range(11)])
+
+    start = time.monotonic()
+    asyncio.run(main())
+    # One call right away from the burst, then one every 1/20 s
+    assert time.monotonic() - start >= 10 / 20 * 0.9
+    assert len(provider.calls) == 11
+
+def test_rate_limit_lowers_rate_until_it_recovers():
+    bucket = scheduler.get_bucket('fake')
+
+    async def main():
+        await scheduler.run('fake', FakeProvider(ProviderError(429)))
+        lowered = bucket['rate']
+        for _ in range(10):
+            await scheduler.run('fake', FakeProvider())
+        return lowered
+
+    lowered = asyncio.run(main())
+    assert lowered == pytest.approx(20.0 / 2 * 1.1)
+    assert bucket['rate'] == 20.0
+
+def test_retry_after_blocks_the_bucket():
+    provider = FakeProvider(ProviderError(429, {'retry-after': '0.3'}))
+    asyncio.run(scheduler.run('fake', provider))
+    assert provider.calls[1] - provider.calls[0] >= 0.3 * 0.9
+
+def test_no_remaining_requests_blocks_the_bucket():
+    scheduler.update_from_headers('fake', {'x-ratelimit-remaining-requests': '0', 'x-ratelimit-reset-requests': '300ms'})
+    start = time.monotonic()
+    asyncio.run(scheduler.run('fake', FakeProvider()))
+    assert time.monotonic() - start >= 0.3 * 0.9
+    assert scheduler.parse_duration('6m0s') == 360 and scheduler.parse_duration('20ms') == 0.02
+
+def test_non_retryable_errors_are_raised_at_once():
+    provider = FakeProvider(ProviderError(400))
+    with pytest.raises(ProviderError):
+        asyncio.run(scheduler.run('fake', provider))
+    assert len(provider.calls) == 1
+
+def test_rate_limits_can_be_left_to_the_caller():
+    bucket = scheduler.get_bucket('fake')
+    too_large = FakeProvider(ProviderError(429))
+    with pytest.raises(ProviderError):
+        asyncio.run(scheduler.run('fake', too_large, retry_rate_limits=False))
+    assert len(too_large.calls) == 1 and bucket['rate'] == 20.0
+    # Server errors are still retried
+    flaky = FakeProvider(ProviderError(500), ProviderError(503))
+    assert asyncio.run(scheduler.run('fake', flaky, retry_rate_limits=False)) == 'ok'
+    assert len(flaky.calls) == 3
+
+def test_retries_are_limited():
+    provider = FakeProvider(*[ProviderError(500)] * 3)
+    with pytest.raises(ProviderError):
+        asyncio.run(scheduler.run('fake', provider, retries=2))
+    assert len(provider.calls) == 3
+
+def test_cancelled_waiter_is_removed():
+    bucket = scheduler.get_bucket('fake')
+
+    async def main():
+        bucket['blocked_until'] = time.monotonic() + 60
+        waiting = asyncio.create_task(scheduler.run('fake', FakeProvider()))
+        await asyncio.sleep(0.01)
+        assert len(bucket['waiters']) == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(main())
+    assert bucket['waiters'] == []
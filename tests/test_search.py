@@ -0,0 +1,26 @@
+import pytest
+import search
+from conversation_format import Message
+
+@pytest.fixture
+def index(workdir, monkeypatch):
+    monkeypatch.setattr(search, 'connection', None)
+    monkeypatch.setattr(search, 'BATCH_SIZE', 7)
+    conversation = [Message('34600000001', i % 2 == 0, 'Ana <3', f'mensaje {i} sobre la <cena> & postre', f'm{i}', 1000 + i) for i in range(60)]
+    assert search.index_conversations({'34600000001': conversation}.items()) == 60
+    return conversation
+
+def test_backfill_skips_indexed_messages(index):
+    search.index_message('34600000001', index[0])
+    assert search.index_conversations({'34600000001': index}.items()) == 0
+
+def test_results_are_escaped(index):
+    result = search.search('cena', 1)[0]
+    assert result["name"] == 'Ana <3'
+    assert '<b>cena</b>' in result["snippet"]
+    assert '&amp; postre' in result["snippet"]
+
+def test_limit_is_clamped(index):
+    assert len(search.search('mensaje', -1)) == 1
+    assert len(search.search('mensaje', 1000)) == search.MAX_RESULTS
+    assert search.search('   ', 10) == []
@@ -0,0 +1,66 @@
+import asyncio, pickle, pytest
+from fastapi import Response
+import storage, conversation_format
+from conversation_format import Message
+
+@pytest.fixture
+def api(workdir, monkeypatch):
+    import api
+    monkeypatch.setattr(api, 'ready', asyncio.Event())
+    monkeypatch.setattr(api, 'startup_error', None)
+    monkeypatch.setattr(api, 'conversation_files', {})
+    monkeypatch.setattr(api, 'conversations', {})
+    monkeypatch.setattr(api, 'message_ids', {})
+    monkeypatch.setattr(api.search, 'connection', None)
+    monkeypatch.setattr(api, 'background_tasks', [])
+    return api
+
+def test_failed_warmup_is_reported(api, monkeypatch):
+    def get_bot():
+        raise ValueError('Invalid token')
+    monkeypatch.setattr(api, 'get_bot', get_bot)
+
+    async def run():
+        waiting = asyncio.create_task(api.complete({"chatId": "34600000001", "messageId": "m1"}))
+        await api.warmup()
+        response = Response()
+        health = await api.health(response)
+        return await asyncio.wait_for(waiting, 1), health, response.status_code
+
+    result, health, status = asyncio.run(run())
+    assert result["error"] and 'Invalid token' in result["message"]
+    assert status == 503 and health["status"] == "error"
+
+def test_warmup_sets_ready(api, monkeypatch):
+    monkeypatch.setattr(api, 'get_bot', lambda: None)
+    monkeypatch.setattr(api.notifier, 'start', lambda bot, chat_id: None)
+
+    async def run():
+        await api.warmup()
+        response = Response()
+        return await api.health(response), response.status_code
+
+    health, status = asyncio.run(run())
+    assert health["ready"] and status == 200
+
+def test_conversations_are_read_when_used(api, workdir, monkeypatch):
+    monkeypatch.setattr(api, 'get_bot', lambda: None)
+    monkeypatch.setattr(api.notifier, 'start', lambda bot, chat_id: None)
+    (workdir / 'conversations').mkdir(exist_ok=True)
+    stored = [Message('34600000001', i % 2 == 0, 'Ana', f'hola {i}', f'm{i}', 1000 + i) for i in range(10)]
+    storage.write_file(f'conversations/34600000001{conversation_format.EXTENSION}', conversation_format.encode(stored))
+    # Pickled by a previous version
+    storage.write_file('conversations/34600000002.pkl', pickle.dumps([{"from": "34600000002", "fromMe": False, "name": "Luis", "content": "buenas", "messageId": "p1", "timestamp": 1000}]))
+
+    async def run():
+        await api.warmup()
+        listed = sorted(api.conversation_files), dict(api.conversations)
+        legacy = await api.get_conversation('34600000002')
+        return listed, legacy, await api.get_conversation('34600000003')
+
+    (files, loaded), legacy, missing = asyncio.run(run())
+    assert files == ['34600000001', '34600000002'] and loaded == {}
+    assert [m.content for m in legacy] == ['buenas']
+    assert missing is None
+    # The backfill read every stored chat
+    assert [r["messageId"] for r in api.search.search('hola 3')] == ['m3']
@@ -0,0 +1,102 @@
+import os, asyncio, pickle, threading, pytest
+import storage
+
+def write_versions(path, *versions):
+    for data in versions:
+        storage.write_file(path, data)
+
+def test_record_round_trip(workdir):
+    write_versions('state.bin', b'first')
+    assert storage.read_file('state.bin') == b'first'
+    assert storage.list_files('.', '.bin') == ['state.bin']
+
+@pytest.mark.parametrize('damage', ['truncate', 'flip', 'header'])
+def test_corrupted_record_falls_back_to_backup(workdir, damage):
+    write_versions('state.bin', b'first version', b'second version')
+    with open('state.bin', 'r+b') as f:
+        if damage == 'truncate':
+            f.truncate(os.path.getsize('state.bin') - 3)
+        elif damage == 'flip':
+            f.seek(-1, os.SEEK_END)
+            f.write(b'X')
+        else:
+            f.truncate(6)
+    assert storage.read_file('state.bin') == b'first version'
+
+def test_corrupted_record_without_backup_raises(workdir):
+    write_versions('state.bin', b'only version')
+    with open('state.bin', 'r+b') as f:
+        f.truncate(os.path.getsize('state.bin') - 1)
+    with pytest.raises(storage.CorruptedFile):
+        storage.read_file('state.bin')
+
+def test_crash_before_rename_keeps_previous_version(workdir, monkeypatch):
+    write_versions('state.bin', b'first version')
+    os_replace = os.replace
+    def crash(source, destination):
+        if destination == 'state.bin':
+            raise OSError('Power failure')
+        return os_replace(source, destination)
+    with monkeypatch.context() as patch:
+        patch.setattr(os, 'replace', crash)
+        with pytest.raises(OSError):
+            storage.write_file('state.bin', b'second version')
+    assert storage.read_file('state.bin') == b'first version'
+    assert storage.list_files('.', '.bin') == ['state.bin']
+
+def test_leftover_temporary_file_is_ignored(workdir):
+    write_versions('state.bin', b'first version')
+    # A crash after writing the temporary file, before renaming it
+    temporary = storage.write_temporary('state.bin', b'second version')
+    assert os.path.exists(temporary)
+    assert storage.read_file('state.bin') == b'first version'
+    assert storage.list_files('.', '.bin') == ['state.bin']
+
+def test_legacy_pickles_are_read(workdir):
+    with open('legacy.pkl', 'wb') as f:
+        pickle.dump({"messages": [1, 2, 3]}, f)
+    assert storage.load_pickle('legacy.pkl') == {"messages": [1, 2, 3]}
+
+def test_truncated_legacy_pickle_falls_back_to_backup(workdir):
+    with open('legacy.pkl', 'wb') as f:
+        pickle.dump(list(range(100)), f)
+    storage.save_pickle_sync('legacy.pkl', list(range(200)))
+    # The backup is the legacy pickle, the new file gets truncated by a crash
+    with open('legacy.pkl', 'r+b') as f:
+        f.truncate(10)
+    assert storage.load_pickle('legacy.pkl') == list(range(100))
+
+def test_concurrent_writers_of_a_path(workdir):
+    payloads = [bytes([i]) * 100_000 for i in range(8)]
+    errors = []
+    def write(data):
+        try:
+            for _ in range(10):
+                storage.write_file('state.bin', data)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=write, args=(data,)) for data in payloads]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert storage.read_file('state.bin') in payloads
+    assert storage.read_file(storage.backup_path('state.bin')) in payloads
+    assert sorted(os.listdir('.')) == ['state.bin', 'state.bin.bak']
+
+def test_concurrent_saves_share_a_commit(workdir, monkeypatch):
+    batches = []
+    commit = storage.commit
+    def counting_commit(batch):
+        batches.append(len(batch))
+        return commit(batch)
+    monkeypatch.setattr(storage, 'commit', counting_commit)
+
+    async def run():
+        await asyncio.gather(*[storage.save(f'{i % 5}.bin', str(i).encode()) for i in range(50)])
+
+    asyncio.run(run())
+    assert batches == [5]
+    # Only the latest data of each path is written
+    assert [storage.read_file(f'{i}.bin') for i in range(5)] == [str(45 + i).encode() for i in range(5)]
@@ -0,0 +1,35 @@
+import threading, pytest
+import style
+from conversation_format import Message
+
+CHAT_ID = '34600000001'
+
+@pytest.fixture(autouse=True)
+def empty_profiles(workdir, monkeypatch):
+    monkeypatch.setattr(style, 'profiles', {})
+
+def own_message(i):
+    return Message(CHAT_ID, True, 'Me', f'vale jaja nos vemos luego {i}', f'm{i}', 1000 + i)
+
+def test_prompt_needs_enough_messages():
+    conversation = [own_message(i) for i in range(style.MIN_PROFILE_MESSAGES - 1)]
+    assert style.get_style_prompt(CHAT_ID, conversation) is None
+    message = own_message(100)
+    style.update(CHAT_ID, conversation + [message], message)
+    assert 'learned from 20 of their messages' in style.get_style_prompt(CHAT_ID, conversation)
+
+def test_concurrent_updates_are_all_counted():
+    messages = [own_message(i) for i in range(200)]
+    prompts = []
+    def update(part):
+        for message in part:
+            style.update(CHAT_ID, [], message)
+            prompts.append(style.get_style_prompt(CHAT_ID, []))
+    threads = [threading.Thread(target=update, args=(messages[i::4],)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert style.profiles[CHAT_ID]["count"] == 200
+    style.profiles.clear()
+    assert style.get_profile(CHAT_ID, [])["count"] == 200
@@ -1,13 +1,24 @@
-import os, httpx, tempfile, base64, mimetypes, ffmpeg, datetime
+import os, sys, time, tempfile, httpx, base64, mimetypes, ffmpeg, datetime, asyncio
+import scheduler
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
-from elevenlabs.client import ElevenLabs
-from elevenlabs.types import VoiceSettings
+
+if TYPE_CHECKING:
+    from elevenlabs.types import VoiceSettings
 
 load_dotenv()
 
-elevenlabs_client = ElevenLabs(
-  api_key=os.getenv('ELEVENLABS_API_KEY'),
-)
+# Built on first use, importing the ElevenLabs SDK slows down the startup of every process
+elevenlabs_client = None
+
+def get_elevenlabs_client():
+    global elevenlabs_client
+    if elevenlabs_client is None:
+        from elevenlabs.client import ElevenLabs
+        elevenlabs_client = ElevenLabs(
+          api_key=os.getenv('ELEVENLABS_API_KEY'),
+        )
+    return elevenlabs_client
 
 def convert_mp3_to_opus_ffmpeg(input_mp3, output_folder="converted/"):
     # Ensure output folder exists
@@ -30,17 +41,47 @@ def convert_mp3_to_opus_ffmpeg(input_mp3, output_folder="converted/"):
     print(f"Converted file saved as: {output_file}")
     return open(output_file, "rb").read(), r"" + output_file
 
-async def convert_from_b64_and_transcribe(base_64_audio: str) -> str:
-    audio_data = base64.b64decode(base_64_audio.split(',')[1])
-    mime_type = base_64_audio.split(',')[0].split(";")[0].split(":")[1]
-    file_extension = mimetypes.guess_extension(mime_type)
-    if not file_extension:
-        file_extension = f'.{mime_type.split("/")[1]}'
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-        temp_file.write(audio_data)
-        file_path = temp_file.name
-
+# Voice notes shorter than this are not useful as voice cloning samples
+MIN_SAMPLE_DURATION = 1.0
+
+def probe_ogg(audio_data: bytes):
+    # Reads the codec and duration straight from the Ogg container, no need to spawn ffprobe
+    if not audio_data.startswith(b'OggS'):
+        return None, None
+    head = audio_data.find(b'OpusHead')
+    if head == -1:
+        return 'vorbis' if b'\x01vorbis' in audio_data[:512] else None, None
+    pre_skip = int.from_bytes(audio_data[head+10:head+12], 'little')
+    last_page = audio_data.rfind(b'OggS')
+    granule = int.from_bytes(audio_data[last_page+6:last_page+14], 'little', signed=True)
+    if granule < 0:
+        return 'opus', None
+    # Opus granule positions are always expressed at 48kHz
+    return 'opus', max(0, granule - pre_skip) / 48000
+
+def decode_audio(base_64_audio: str) -> dict:
+    """Decodes a WhatsApp data URI once, so every consumer can share the same bytes."""
+    header, data = base_64_audio.split(',', 1)
+    audio_data = base64.b64decode(data)
+    mime_type = header.split(";")[0].split(":")[1]
+    codec, duration = probe_ogg(audio_data)
+    if codec is not None:
+        file_extension = '.ogg'
+    else:
+        file_extension = mimetypes.guess_extension(mime_type)
+        if not file_extension:
+            file_extension = f'.{mime_type.split("/")[1]}'
+    return {
+        "data": audio_data,
+        "mime_type": mime_type,
+        "extension": file_extension,
+        "codec": codec,
+        "duration": duration
+    }
+
+async def transcribe_audio(audio: dict) -> str:
+    # Whisper accepts ogg/opus as is, the audio is uploaded from memory
+    async def transcribe():
         async with httpx.AsyncClient() as client:
             response = await client.post(
                 "https://api.openai.com/v1/audio/transcriptions",
@@ -48,27 +89,46 @@ async def convert_from_b64_and_transcribe(base_64_audio: str) -> str:
                     "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}"
                 },
                 files={
-                    "file": open(file_path, 'rb'),
+                    "file": (f'audio{audio["extension"]}', audio["data"], audio["mime_type"]),
                 },
                 data={
                     "model": "whisper-1",
                 },
                 timeout=120
             )
-            print(response.json())
-        # Clean up temporary files
-        #if os.path.exists(file_path):
-        #    os.remove(file_path)
-        
-        return response.json()["text"]
+            response.raise_for_status()
+            return response
+
+    response = await scheduler.run('whisper', transcribe, priority=scheduler.BACKGROUND)
+    return response.json()["text"]
+
+def save_audio(audio: dict, output_file: str) -> str:
+    # The original bytes are stored, transcoding only happens if a consumer needs another format
+    output_file = f'{output_file}{audio["extension"]}'
+    with open(output_file, 'wb') as f:
+        f.write(audio["data"])
+    return output_file
+
+def ensure_mp3(input_file: str) -> str:
+    if input_file.endswith('.mp3'):
+        return input_file
+    output_file = f'{os.path.splitext(input_file)[0]}.mp3'
+    if not os.path.exists(output_file):
+        (
+            ffmpeg
+            .input(input_file)
+            .output(output_file, audio_bitrate="32k", format="mp3", acodec="libmp3lame")
+            .run(overwrite_output=True, quiet=True)
+        )
+    return output_file
 
 async def text_to_speech(text: str, save: bool = False, save_path: str = None, to_base64: bool = False, to_ogg: bool = False, voice_id: str = os.getenv('ELEVENLABS_VOICE_ID')):
-    audio = elevenlabs_client.text_to_speech.convert(
+    # The SDK streams the audio lazily, so the request is only done when the chunks are consumed
+    audio = await scheduler.run('elevenlabs', lambda: asyncio.to_thread(lambda: b''.join(get_elevenlabs_client().text_to_speech.convert(
         text=text,
         voice_id=voice_id,
         model_id="eleven_multilingual_v2"
-    )
-    audio = b''.join([chunk for chunk in audio])
+    ))), priority=scheduler.INTERACTIVE)
     with open("audio.mp3", "wb") as f:
         f.write(audio)
     if to_ogg:
@@ -81,57 +141,91 @@ async def text_to_speech(text: str, save: bool = False, save_path: str = None, t
         return f'data:audio/ogg; codecs=opus;base64,{base64.b64encode(audio).decode('utf-8')}', output_file
     return audio, output_file
 
-def convert_opus_base64_to_mp3(base_64_audio: str, output_file: str):
-    audio_data = base64.b64decode(base_64_audio.split(',')[1])
-    mime_type = base_64_audio.split(',')[0].split(";")[0].split(":")[1]
-    file_extension = mimetypes.guess_extension(mime_type)
-    if not file_extension:
-        file_extension = f'.{mime_type.split("/")[1]}'
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-        temp_file.write(audio_data)
-        file_path = temp_file.name
-    
-    (
-        ffmpeg
-        .input(file_path)
-        .output(output_file, audio_bitrate="32k", format="mp3", acodec="libmp3lame")
-        .run(overwrite_output=True)
-    )
-
-    os.remove(file_path)
-    return output_file
-
-
-def clone_voice_from_samples(samples: list[str], prompt: str, name: str):
-    voice = elevenlabs_client.clone(
+async def clone_voice_from_samples(samples: list[str], prompt: str, name: str):
+    # Voice notes are stored in their original format, ElevenLabs gets mp3
+    files = await asyncio.to_thread(lambda: [ensure_mp3(sample) for sample in samples])
+    voice = await scheduler.run('elevenlabs', lambda: asyncio.to_thread(
+        get_elevenlabs_client().clone,
         name=name,
         description=prompt,
-        files=samples
-    )
+        files=files
+    ), priority=scheduler.INTERACTIVE)
     return voice
 
-def edit_voice(voice_id: str, files: list[str] = None, name: str = None, description: str = None, labels: str = None, remove_background_noise: bool = None):
-    return elevenlabs_client.voices.edit(
+async def edit_voice(voice_id: str, files: list[str] = None, name: str = None, description: str = None, labels: str = None, remove_background_noise: bool = None):
+    return await scheduler.run('elevenlabs', lambda: asyncio.to_thread(
+        get_elevenlabs_client().voices.edit,
         voice_id=voice_id,
         files=files,
         name=name,
         description=description,
         labels=labels,
         remove_background_noise=remove_background_noise
-    )
+    ), priority=scheduler.INTERACTIVE)
 
-def edit_voice_settings(voice_id: str, request: VoiceSettings):
-    return elevenlabs_client.voices.edit_settings(
+async def edit_voice_settings(voice_id: str, request: 'VoiceSettings'):
+    return await scheduler.run('elevenlabs', lambda: asyncio.to_thread(
+        get_elevenlabs_client().voices.edit_settings,
         voice_id=voice_id,
         request=request
-    )
+    ), priority=scheduler.INTERACTIVE)
 
-def delete_voice(voice_id: str):
-    return elevenlabs_client.voices.delete(
+async def delete_voice(voice_id: str):
+    return await scheduler.run('elevenlabs', lambda: asyncio.to_thread(
+        get_elevenlabs_client().voices.delete,
         voice_id=voice_id
-    )
+    ), priority=scheduler.INTERACTIVE)
 
-def get_voices():
-    voices = elevenlabs_client.voices.get_all()
+async def get_voices():
+    voices = await scheduler.run('elevenlabs', lambda: asyncio.to_thread(lambda: get_elevenlabs_client().voices.get_all()), priority=scheduler.INTERACTIVE)
     return voices
+
+def legacy_voice_note_pipeline(base_64_audio: str, output_folder: str):
+    # What every voice note went through before: decoded and transcoded to mp3 for the samples,
+    # then decoded again and written to a temporary file to be uploaded to Whisper
+    audio_data = base64.b64decode(base_64_audio.split(',')[1])
+    input_file = os.path.join(output_folder, 'input.ogg')
+    with open(input_file, 'wb') as f:
+        f.write(audio_data)
+    (
+        ffmpeg
+        .input(input_file)
+        .output(os.path.join(output_folder, 'sample.mp3'), audio_bitrate="32k", format="mp3", acodec="libmp3lame")
+        .run(overwrite_output=True, quiet=True)
+    )
+    os.remove(input_file)
+    audio_data = base64.b64decode(base_64_audio.split(',')[1])
+    with open(os.path.join(output_folder, 'upload.ogg'), 'wb') as f:
+        f.write(audio_data)
+
+def voice_note_pipeline(base_64_audio: str, output_folder: str):
+    audio = decode_audio(base_64_audio)
+    save_audio(audio, os.path.join(output_folder, 'sample'))
+
+def cpu_time():
+    # ffmpeg runs in a child process, its CPU time counts as well
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def benchmark(path=None, runs=20):
+    """Compares the CPU time spent on each inbound voice note by the previous pipeline and the current one.
+    Whisper isn't called, the upload costs the same in both."""
+    with tempfile.TemporaryDirectory() as folder:
+        if path is None:
+            # A 30 seconds test tone, encoded like WhatsApp voice notes
+            path = os.path.join(folder, 'voice_note.ogg')
+            ffmpeg.input('sine=frequency=440:duration=30', f='lavfi').output(path, acodec='libopus', audio_bitrate='32k', format='ogg').run(quiet=True)
+        with open(path, 'rb') as f:
+            base_64_audio = f'data:audio/ogg; codecs=opus;base64,{base64.b64encode(f.read()).decode()}'
+        for label, pipeline in (('before', legacy_voice_note_pipeline), ('after', voice_note_pipeline)):
+            start_cpu, start = cpu_time(), time.perf_counter()
+            for _ in range(runs):
+                pipeline(base_64_audio, folder)
+            took_cpu, took = cpu_time() - start_cpu, time.perf_counter() - start
+            print(f'{label}: {took_cpu / runs * 1000:.2f} ms of CPU and {took / runs * 1000:.2f} ms per voice note')
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'benchmark':
+        print('Usage: python utils.py benchmark [voice_note.ogg]')
+    else:
+        benchmark(sys.argv[2] if len(sys.argv) > 2 else None)
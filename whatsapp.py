@@ -1,8 +1,8 @@
-from WPP_Whatsapp import Create
-import os, asyncio, random, pickle, logfire, requests
+import os, asyncio, random, logfire, requests, storage
 from dotenv import load_dotenv
 import logfire
 from httpx import AsyncClient
+from health import start_health_server
 load_dotenv()
 
 logfire.configure(
@@ -14,6 +14,16 @@ logfire.configure(
 
 my_phone_number = os.getenv('MY_PHONE_NUMBER')
 
+def load_sendable_messages():
+    # A corrupted file is skipped so it doesn't block the rest of the queue
+    sendable = []
+    for filename in storage.list_files('sendable_messages'):
+        try:
+            sendable.append(storage.load_pickle(f'sendable_messages/{filename}'))
+        except Exception as e:
+            logfire.error(f'Error loading sendable message {filename}', error=e)
+    return sendable
+
 async def check_sendable_messages():
     try:
         messages = [
@@ -24,10 +34,7 @@ async def check_sendable_messages():
                 "filename": message_data['filename'],
                 "audio_filename": message_data.get('audio_filename', None)
             }
-            for message_data in [
-                pickle.load(open(f'sendable_messages/{filename}', 'rb'))
-                for filename in os.listdir('sendable_messages')
-            ]
+            for message_data in load_sendable_messages()
         ]
         if len(messages) > 0:
             logfire.info(f'Found {len(messages)} sendable messages')
@@ -36,10 +43,9 @@ async def check_sendable_messages():
         logfire.error('Error checking sendable messages', error=e)
         return []
 
-creator = Create(session="whatsapp")
-client = creator.start()
-if creator.state != 'CONNECTED':
-    raise Exception(creator.state)
+# The browser session is started by main()
+creator = None
+client = None
 
 async def sendable_message_checker():
         try:
@@ -81,7 +87,7 @@ async def sendable_message_checker():
                                 if message['type'] == 'audio':
                                     try:
                                         async with AsyncClient(timeout=120) as async_client:
-                                            await async_client.post('http://localhost:47549/delete_sample', json={'telephone': my_phone_number, 'sample': result['id'].split('_')[-1]+'.mp3'})
+                                            await async_client.post('http://localhost:47549/delete_sample', json={'telephone': my_phone_number, 'sample': result['id'].split('_')[-1]})
                                             logfire.info('Deleted sample after sending audio')
                                     except Exception as e:
                                         logfire.error('Error deleting sample after sending audio', error=e)
@@ -109,7 +115,8 @@ def new_message_received(message):
                     logfire.error('Error downloading audio media', message_id=message.get('id'), error=e)
             
             try:
-                requests.post('http://localhost:47549/new_message', json=message)
+                # Voice notes wait for their transcription, the timeout only prevents hanging forever
+                requests.post('http://localhost:47549/new_message', json=message, timeout=300)
                 logfire.info('Forwarded message to API', message_id=message.get('id'))
             except Exception as e:
                 logfire.error('Error forwarding message to API', message_id=message.get('id'), error=e)
@@ -118,7 +125,13 @@ def new_message_received(message):
 
 def main():
     try:
-        global creator
+        global creator, client
+        start_health_server(47551, lambda: creator is not None and creator.state == 'CONNECTED')
+        from WPP_Whatsapp import Create
+        creator = Create(session="whatsapp")
+        client = creator.start()
+        if creator.state != 'CONNECTED':
+            raise Exception(creator.state)
         try:
             creator.loop.create_task(sendable_message_checker())
             creator.client.onAnyMessage(new_message_received)